@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic presence and users data for benchmarks.
+
+Usage: bin/python-console benchmarks/datagen.py output.csv [users] [days]
+
+Users XML file matching the CSV is written next to it, with .xml suffix.
+"""
+from __future__ import print_function
+
+import random
+import sys
+from datetime import date, timedelta
+
+FIRST_DAY = date(2010, 1, 4)
+
+
+def _clock(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '{0:02d}:{1:02d}:{2:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def write_csv(path, users, days, seed=0):
+    """
+    Writes presence CSV with one entry per user and working day.
+
+    Rows are ordered by user, then by date, like exports from the intranet.
+    Returns number of rows written.
+    """
+    rnd = random.Random(seed)
+    dates = [
+        (FIRST_DAY + timedelta(days=i)).isoformat()
+        for i in xrange(days)
+        if (FIRST_DAY + timedelta(days=i)).weekday() < 5
+    ]
+    rows = 0
+    with open(path, 'w') as output:
+        for user_id in xrange(1, users + 1):
+            lines = []
+            for day in dates:
+                start = rnd.randint(7 * 3600, 11 * 3600)
+                end = min(start + rnd.randint(3600, 10 * 3600), 86399)
+                lines.append('{0},{1},{2},{3}\n'.format(
+                    user_id, day, _clock(start), _clock(end)))
+            output.writelines(lines)
+            rows += len(lines)
+    return rows
+
+
+def write_users_xml(path, users):
+    """
+    Writes users XML file in intranet format for user ids 1..users.
+    """
+    with open(path, 'w') as output:
+        output.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.example.com</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n    <users>\n'
+        )
+        for user_id in xrange(1, users + 1):
+            output.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>User {0}</name>\n'
+                '        </user>\n'.format(user_id)
+            )
+        output.write('    </users>\n</intranet>\n')
+
+
+def main():
+    """
+    Writes synthetic CSV file given on command line.
+    """
+    path = sys.argv[1]
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    print('{0} rows written to {1}'.format(write_csv(path, users, days), path))
+    xml_path = '{0}.xml'.format(path.rsplit('.', 1)[0])
+    write_users_xml(xml_path, users)
+    print('{0} users written to {1}'.format(users, xml_path))
+
+
+if __name__ == '__main__':
+    main()
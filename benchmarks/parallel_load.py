@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Measures scaling of parallel CSV loader from 1 to N worker processes.
+
+Usage: bin/python-console benchmarks/parallel_load.py [users] [days] [max]
+
+Synthetic file has users x days (working days only) rows, 2000 x 1400
+by default, which is two million rows. `max` defaults to number of CPUs.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from presence_analyzer.loader import load_store, load_store_parallel
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from datagen import write_csv  # noqa pylint: disable=wrong-import-position
+
+
+def main():
+    """
+    Runs loader with increasing number of workers and prints timings.
+    """
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 1400
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 \
+        else multiprocessing.cpu_count()
+
+    handle, path = tempfile.mkstemp(suffix='.csv')
+    os.close(handle)
+    try:
+        rows = write_csv(path, users, days)
+        print('{0} rows, {1:.1f} MB'.format(
+            rows, os.path.getsize(path) / 1024.0 / 1024))
+
+        started = time.time()
+        load_store(path)
+        baseline = time.time() - started
+        print('{0:>8}: {1:8.2f} s'.format('serial', baseline))
+
+        for workers in range(1, max_workers + 1):
+            started = time.time()
+            load_store_parallel(path, workers)
+            elapsed = time.time() - started
+            print('{0:>8}: {1:8.2f} s  {2:5.2f}x'.format(
+                workers, elapsed, baseline / elapsed))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
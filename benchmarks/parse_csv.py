@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Compares fast CSV parser with the original dict-based loader and the
+csv/strptime path of PresenceStore loader.
+
+Usage: bin/python-console benchmarks/parse_csv.py [scale] [repeat]
+
+Input is runtime/data/sample_data.csv repeated `scale` times (100 by
+default), written to a temporary file.
+"""
+from __future__ import print_function
+
+import csv
+import logging
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+
+from presence_analyzer.loader import load_store
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SAMPLE_CSV = os.path.join('runtime', 'data', 'sample_data.csv')
+
+
+def load_baseline(path):
+    """
+    Original loader of presence data (get_data before PresenceStore),
+    kept verbatim as the reference point.
+    """
+    data = {}
+    with open(path, 'r') as csvfile:
+        presence_reader = csv.reader(csvfile, delimiter=str(','))
+        for i, row in enumerate(presence_reader):
+            if len(row) != 4:
+                # ignore header and footer lines
+                continue
+
+            try:
+                user_id = int(row[0])
+                date = datetime.strptime(row[1], '%Y-%m-%d').date()
+                start = datetime.strptime(row[2], '%H:%M:%S').time()
+                end = datetime.strptime(row[3], '%H:%M:%S').time()
+            except (ValueError, TypeError):
+                log.debug('Problem with line %d: ', i, exc_info=True)
+
+            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+
+    return data
+
+
+def make_input(scale):
+    """
+    Writes sample data repeated `scale` times to temporary file.
+    """
+    with open(SAMPLE_CSV, 'r') as sample:
+        content = sample.read()
+    handle, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(handle, 'w') as output:
+        for _ in xrange(scale):
+            output.write(content)
+    return path
+
+
+def main():
+    """
+    Runs benchmark and prints best time of each loader.
+    """
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    path = make_input(scale)
+    try:
+        with open(path, 'r') as data:
+            lines = sum(1 for _ in data)
+        print('{0} lines, best of {1}'.format(lines, repeat))
+        results = {}
+        loaders = (
+            ('baseline', lambda: load_baseline(path)),
+            ('strptime', lambda: load_store(path, fast=False)),
+            ('fast', lambda: load_store(path, fast=True)),
+        )
+        for name, function in loaders:
+            best = min(timeit.repeat(function, repeat=repeat, number=1))
+            results[name] = best
+            print('{0:>10}: {1:8.3f} s  {2:10.0f} lines/s'.format(
+                name, best, lines / best))
+        print('   speedup: {0:8.2f}x'.format(
+            results['baseline'] / results['fast']))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of utils hot paths and /api/v1 routes.
+
+Usage: bin/python-console benchmarks/suite.py [options]
+
+Generates synthetic data of given size (users x days), runs
+micro-benchmarks of utils functions and concurrent load through the WSGI
+app, then prints results as JSON (or writes them to --output) so runs can
+be compared.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+from presence_analyzer import (  # noqa pylint: disable=unused-import
+    utils,
+    views,
+)
+from presence_analyzer.loader import load_store
+from presence_analyzer.main import app
+from presence_analyzer.users import parse_users
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from datagen import (  # noqa pylint: disable=wrong-import-position
+    write_csv,
+    write_users_xml,
+)
+
+ROUTES = (
+    '/api/v1/users',
+    '/api/v1/mean_time_weekday/{0}',
+    '/api/v1/presence_weekday/{0}',
+    '/api/v1/presence_start_end_per_weekday/{0}',
+)
+
+
+def percentile(values, fraction):
+    """
+    Returns nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return 0
+    rank = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def measure(func, repeat, number=1):
+    """
+    Times func, returns summary in milliseconds per call.
+    """
+    timings = timeit.repeat(func, repeat=repeat, number=number)
+    per_call = [timing * 1000 / number for timing in timings]
+    return {
+        'repeat': repeat,
+        'number': number,
+        'best_ms': min(per_call),
+        'mean_ms': sum(per_call) / len(per_call),
+    }
+
+
+def micro_benchmarks(csv_path, xml_path, repeat):
+    """
+    Runs micro-benchmarks of loading and aggregation functions.
+    """
+    data = utils.get_data()
+    user_id = data.keys()[len(data) // 2]
+    user = data[user_id]
+    stats = data.weekday_index[user_id]
+    grouped = utils.start_end_group_by_weekday(user)
+    intervals = [
+        interval for weekday in utils.group_by_weekday(user)
+        for interval in weekday
+    ]
+    payload = utils.mean_time_weekday(stats)
+    with app.test_request_context():
+        jsonified = utils.jsonify(lambda: payload)
+        return {
+            'load_store': measure(lambda: load_store(csv_path), repeat),
+            'parse_users': measure(lambda: parse_users(xml_path), repeat),
+            'get_data_cached': measure(utils.get_data, repeat, 1000),
+            'get_users_cached': measure(utils.get_users, repeat, 1000),
+            'group_by_weekday': measure(
+                lambda: utils.group_by_weekday(user), repeat, 100),
+            'start_end_group_by_weekday': measure(
+                lambda: utils.start_end_group_by_weekday(user), repeat, 100),
+            'mean_start_end_by_weekday': measure(
+                lambda: utils.mean_start_end_by_weekday(grouped), repeat, 100),
+            'mean': measure(lambda: utils.mean(intervals), repeat, 1000),
+            'mean_time_weekday': measure(
+                lambda: utils.mean_time_weekday(stats), repeat, 1000),
+            'presence_weekday': measure(
+                lambda: utils.presence_weekday(stats), repeat, 1000),
+            'presence_start_end': measure(
+                lambda: utils.presence_start_end(stats), repeat, 1000),
+            'jsonify': measure(jsonified, repeat, 1000),
+        }
+
+
+def load_test(user_ids, requests, concurrency, seed=0):
+    """
+    Sends requests to random /api/v1 routes from concurrent threads.
+
+    Returns throughput and latency percentiles.
+    """
+    rnd = random.Random(seed)
+    urls = [
+        rnd.choice(ROUTES).format(rnd.choice(user_ids))
+        for _ in xrange(requests)
+    ]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(chunk):
+        """
+        Sends requests of one thread.
+        """
+        client = app.test_client()
+        timings = []
+        failed = 0
+        for url in chunk:
+            started = time.time()
+            response = client.get(url)
+            response.get_data()
+            timings.append(time.time() - started)
+            if response.status_code != 200:
+                failed += 1
+        with lock:
+            latencies.extend(timings)
+            errors[0] += failed
+
+    threads = [
+        threading.Thread(target=worker, args=(urls[i::concurrency],))
+        for i in range(concurrency)
+    ]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors[0],
+        'elapsed_s': elapsed,
+        'throughput_rps': requests / elapsed,
+        'latency_ms': dict(
+            (name, percentile(latencies, fraction) * 1000)
+            for name, fraction in (
+                ('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))
+        ),
+    }
+
+
+def main():
+    """
+    Parses options, runs benchmarks and reports results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--days', type=int, default=700)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', help='write JSON results to file')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(tmp_dir, 'data.csv')
+        xml_path = os.path.join(tmp_dir, 'users.xml')
+        rows = write_csv(csv_path, args.users, args.days)
+        write_users_xml(xml_path, args.users)
+        app.config.update({'DATA_CSV': csv_path, 'USERS_XML': xml_path})
+
+        results = {
+            'params': dict(vars(args), rows=rows),
+            'python': platform.python_version(),
+            'micro': micro_benchmarks(csv_path, xml_path, args.repeat),
+            'load': load_test(
+                range(1, args.users + 1), args.requests, args.concurrency),
+        }
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report)
+    print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,11 @@ setup(
         'Flask-Mako',
         'lxml',
     ],
+    extras_require={
+        'async': ['gevent'],
+        'inotify': ['pyinotify'],
+        'numpy': ['numpy'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Weekday aggregation of whole arrays of presence entries.
+
+Uses NumPy (optional dependency) when installed: weekdays come from date
+ordinals, intervals from end minus start and grouped counts and sums from
+bincount over (user, weekday) keys. Pure Python fallback returns identical
+results.
+"""
+from __future__ import unicode_literals
+
+import calendar
+import time
+from array import array
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# below this many entries plain loops beat array setup
+NUMPY_MIN_ENTRIES = 256
+
+
+def weekday_of(ordinal):
+    """
+    Returns weekday (Monday is 0) of given proleptic Gregorian ordinal.
+    """
+    # date.fromordinal(1) is a Monday
+    return (ordinal - 1) % 7
+
+
+def add_entry(stats, day, start, end, count=1):
+    """
+    Adds entry to seven [count, interval sum, start sum, end sum] lists of
+    weekday stats being built; count=-1 removes it again.
+    """
+    curr = stats[weekday_of(day)]
+    curr[0] += count
+    curr[1] += count * (end - start)
+    curr[2] += count * start
+    curr[3] += count * end
+
+
+def weekday_stats(rows):
+    """
+    Aggregates (date ordinal, start, end) rows by weekday.
+
+    Returns list of seven (count, interval sum, start sum, end sum) tuples,
+    one for every day in week.
+    """
+    stats = [[0, 0, 0, 0] for _ in range(7)]
+    for day, start, end in rows:
+        add_entry(stats, day, start, end)
+    return [tuple(item) for item in stats]
+
+
+def _use_numpy(use_numpy, size):
+    """
+    Tells whether NumPy should be used for given number of items.
+    """
+    if use_numpy is None:
+        return numpy is not None and size >= NUMPY_MIN_ENTRIES
+    if use_numpy and numpy is None:
+        raise ValueError('NumPy is not installed')
+    return use_numpy
+
+
+def _as_numpy(values):
+    """
+    Returns values as int64 NumPy array, without copying typed arrays.
+    """
+    if isinstance(values, array):
+        values = numpy.frombuffer(values, dtype=values.typecode)
+    else:
+        values = numpy.fromiter(values, dtype=numpy.int64, count=len(values))
+    return values.astype(numpy.int64)
+
+
+def _totals_numpy(user_ids, bounds, dates, starts, ends):
+    """
+    Returns (users x 7 x 4) list of weekday stats computed by NumPy.
+    """
+    users = len(user_ids)
+    dates, starts, ends = _as_numpy(dates), _as_numpy(starts), _as_numpy(ends)
+    user_index = numpy.repeat(numpy.arange(users),
+                              numpy.diff(_as_numpy(bounds)))
+    keys = user_index * 7 + (dates - 1) % 7
+    size = users * 7
+    columns = [numpy.bincount(keys, minlength=size)] + [
+        # float sums of seconds are exact far beyond any real data size
+        numpy.bincount(keys, weights=weights, minlength=size)
+        for weights in (ends - starts, starts, ends)
+    ]
+    return numpy.column_stack(columns).astype(numpy.int64) \
+        .reshape(users, 7, 4).tolist()
+
+
+def _totals_python(bounds, dates, starts, ends, index):
+    """
+    Returns weekday stats of index-th user computed by plain loop.
+    """
+    begin, end = bounds[index], bounds[index + 1]
+    return weekday_stats(izip(dates[begin:end], starts[begin:end],
+                              ends[begin:end]))
+
+
+def weekday_totals(user_ids, bounds, dates, starts, ends, only=None,
+                   use_numpy=None):
+    """
+    Aggregates entries of all users by weekday at once.
+
+    Entries of user_ids[i] occupy bounds[i]:bounds[i + 1] of dates, starts
+    and ends, like in PresenceStore. Returns dict mapping user_id to seven
+    (count, interval sum, start sum, end sum) tuples. `only` limits the
+    result to given users; NumPy is used when installed and worth it unless
+    use_numpy says otherwise.
+    """
+    if _use_numpy(use_numpy, len(dates)):
+        totals = _totals_numpy(user_ids, bounds, dates, starts, ends)
+        return dict(
+            (user_id, [tuple(item) for item in totals[i]])
+            for i, user_id in enumerate(user_ids)
+            if only is None or user_id in only
+        )
+    return dict(
+        (user_id, _totals_python(bounds, dates, starts, ends, i))
+        for i, user_id in enumerate(user_ids)
+        if only is None or user_id in only
+    )
+
+
+def merge_weekday_stats(stats):
+    """
+    Sums weekday stats of many users into weekday stats of the group.
+    """
+    result = [[0, 0, 0, 0] for _ in range(7)]
+    for user_stats in stats:
+        for curr, item in izip(result, user_stats):
+            for i, value in enumerate(item):
+                curr[i] += value
+    return [tuple(item) for item in result]
+
+
+def format_seconds(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return time.strftime('%H:%M:%S', time.gmtime(seconds))
+
+
+def average(total, count):
+    """
+    Calculates arithmetic mean from sum and count of items.
+    Returns zero when there are no items.
+    """
+    return float(total) / count if count > 0 else 0
+
+
+def _means_numpy(stats):
+    """
+    Returns interval sums and mean interval, start and end of every user
+    computed by NumPy.
+    """
+    matrix = numpy.array(stats, dtype=numpy.float64).reshape(-1, 7, 4)
+    counts = matrix[:, :, 0]
+    means = matrix[:, :, 1:] / numpy.maximum(counts, 1)[:, :, None]
+    result = []
+    for row_counts, row_sums, row_means in izip(
+            counts.tolist(),
+            matrix[:, :, 1].astype(numpy.int64).tolist(),
+            means.tolist()):
+        # integer zero for days without entries, like the loop version
+        result.append([row_sums] + [
+            [value if count else 0
+             for value, count in izip(column, row_counts)]
+            for column in zip(*row_means)
+        ])
+    return result
+
+
+def _means_python(stats):
+    """
+    Returns interval sums and mean interval, start and end of one user.
+    """
+    result = [[], [], [], []]
+    for count, interval_sum, start_sum, end_sum in stats:
+        result[0].append(interval_sum)
+        for i, total in enumerate((interval_sum, start_sum, end_sum), 1):
+            result[i].append(average(total, count))
+    return result
+
+
+def _series(sums, intervals, starts, ends):
+    """
+    Builds results of the three weekday views from interval sums and mean
+    interval, start and end of every weekday.
+    """
+    days = list(calendar.day_abbr)
+    return {
+        'mean_time_weekday': zip(days, intervals),
+        'presence_weekday': zip(days, sums),
+        'presence_start_end': zip(
+            days,
+            [format_seconds(start) for start in starts],
+            [format_seconds(end) for end in ends],
+        ),
+    }
+
+
+def user_series(stats):
+    """
+    Computes results of all three weekday views from weekday stats of one
+    user, see weekday_series.
+    """
+    return _series(*_means_python(stats))
+
+
+def weekday_series(index, use_numpy=None):
+    """
+    Computes results of all three weekday views for users of index
+    (user_id -> weekday stats) at once.
+
+    Returns dict mapping user_id to dict with 'mean_time_weekday',
+    'presence_weekday' and 'presence_start_end' lists, equal to results of
+    utils functions of the same names.
+    """
+    user_ids = list(index)
+    stats = [index[user_id] for user_id in user_ids]
+    if _use_numpy(use_numpy, len(stats) * 7):
+        means = _means_numpy(stats)
+    else:
+        means = [_means_python(item) for item in stats]
+    return dict(
+        (user_id, _series(*user_means))
+        for user_id, user_means in izip(user_ids, means)
+    )
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Proxy of user avatars with local disk cache.
+
+Avatars are fetched from upstream through bounded pool of keep-alive HTTP
+connections and stored on disk, least recently used ones are removed when
+the cache exceeds its size. Cached avatars older than `revalidate` seconds
+are revalidated upstream by conditional request.
+"""
+from __future__ import unicode_literals
+
+import httplib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from hashlib import sha1
+from threading import BoundedSemaphore, Lock
+from urlparse import urljoin, urlsplit
+
+from presence_analyzer.metrics import inc, timer
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CONNECTIONS = {
+    'http': httplib.HTTPConnection,
+    'https': httplib.HTTPSConnection,
+}
+
+
+class UpstreamError(Exception):
+    """
+    Avatar couldn't be fetched from upstream.
+    """
+
+
+class StaleConnection(Exception):
+    """
+    Reused keep-alive connection was closed by upstream.
+    """
+
+
+class HTTPConnectionPool(object):
+    """
+    Keep-alive HTTP connections shared by threads, at most `size` of them
+    in use at once.
+    """
+    def __init__(self, size=4, timeout=5.0):
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(size)
+        self._lock = Lock()
+        self._idle = {}
+
+    @contextmanager
+    def connection(self, scheme, netloc, fresh=False):
+        """
+        Lends connection to given host for the duration of with block, new
+        one when `fresh` is set.
+
+        Waits when all connections are in use; connection which raised an
+        error is closed instead of returned.
+        """
+        with timer('avatar_pool_wait'):
+            self._slots.acquire()
+        try:
+            connection = None
+            with self._lock:
+                idle = self._idle.get((scheme, netloc))
+                if idle and not fresh:
+                    connection = idle.pop()
+            if connection is None:
+                connection = CONNECTIONS[scheme](netloc, timeout=self.timeout)
+            try:
+                yield connection
+            except Exception:
+                connection.close()
+                raise
+            with self._lock:
+                self._idle.setdefault((scheme, netloc), []).append(connection)
+        finally:
+            self._slots.release()
+
+    def request(self, url, headers=None):
+        """
+        Sends GET request, returns (status, headers, body).
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in CONNECTIONS:
+            raise UpstreamError('Unsupported URL: {0}'.format(url))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        try:
+            try:
+                return self._send(parts, path, headers or {})
+            except StaleConnection:
+                # upstream closed idle keep-alive connection, try new one
+                log.debug('Idle connection to %s was closed, retrying',
+                          parts.netloc)
+                inc('avatar_upstream_retries')
+                return self._send(parts, path, headers or {}, fresh=True)
+        except (httplib.HTTPException, EnvironmentError) as exc:
+            raise UpstreamError('Request of {0} failed: {1}'.format(url, exc))
+
+    def _send(self, parts, path, headers, fresh=False):
+        """
+        Sends GET request over pooled connection.
+
+        Raises StaleConnection when reused connection fails before any
+        response arrives.
+        """
+        with self.connection(parts.scheme, parts.netloc, fresh) as connection:
+            reused = connection.sock is not None
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, EnvironmentError) as exc:
+                if reused:
+                    raise StaleConnection(exc)
+                raise
+            body = response.read()
+        return response.status, dict(response.getheaders()), body
+
+
+class AvatarCache(object):
+    """
+    Avatars stored in directory, at most max_size bytes of them.
+
+    Every avatar is stored as <key> (image) and <key>.json (metadata).
+    Access time is tracked in memory and by modification time of the
+    metadata file, so LRU order survives restarts.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = Lock()
+        self._entries = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            key = filename[:-len('.json')]
+            try:
+                self._entries[key] = (
+                    os.path.getsize(self._path(key)),
+                    os.path.getmtime(self._path(key) + '.json'),
+                )
+            except OSError:
+                continue
+
+    def _path(self, key):
+        """
+        Returns path of image of given key.
+        """
+        return os.path.join(self.directory, key)
+
+    @property
+    def size(self):
+        """
+        Total size of cached images.
+        """
+        with self._lock:
+            return sum(size for size, _ in self._entries.itervalues())
+
+    def get(self, key):
+        """
+        Returns (metadata, image) of given key or None, marking it as used.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries[key] = (self._entries[key][0], time.time())
+        try:
+            with open(self._path(key) + '.json') as meta_file:
+                meta = json.load(meta_file)
+            with open(self._path(key), 'rb') as image_file:
+                body = image_file.read()
+            os.utime(self._path(key) + '.json', None)
+        except (IOError, OSError, ValueError):
+            log.warning('Cached avatar %s is broken', key, exc_info=True)
+            self.remove(key)
+            return None
+        return meta, body
+
+    def _write(self, path, data):
+        """
+        Replaces file atomically.
+        """
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            prefix='.tmp-')
+        with os.fdopen(handle, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, path)
+
+    def put(self, key, meta, body=None):
+        """
+        Stores metadata and image (keeps stored image when body is None),
+        evicting least recently used avatars above max_size.
+        """
+        if body is not None:
+            self._write(self._path(key), body)
+        self._write(self._path(key) + '.json', json.dumps(meta))
+        with self._lock:
+            size = len(body) if body is not None \
+                else self._entries.get(key, (0, 0))[0]
+            self._entries[key] = (size, time.time())
+            total = sum(item[0] for item in self._entries.itervalues())
+            evicted = []
+            for old_key, (old_size, _) in sorted(
+                    self._entries.items(), key=lambda item: item[1][1]):
+                if total <= self.max_size or old_key == key:
+                    break
+                total -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            inc('avatar_cache_evictions')
+            self.remove(old_key)
+
+    def remove(self, key):
+        """
+        Removes avatar of given key.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+        for path in (self._path(key), self._path(key) + '.json'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class AvatarProxy(object):
+    """
+    Avatars fetched from upstream and kept in AvatarCache.
+
+    `upstream` (scheme://host:port) replaces server part of avatar URLs,
+    so a local stub can stand in for the intranet.
+    """
+    def __init__(self, cache, pool, upstream=None, revalidate=86400):
+        self.cache = cache
+        self.pool = pool
+        self.upstream = upstream
+        self.revalidate = revalidate
+
+    def upstream_url(self, url):
+        """
+        Returns URL of avatar at configured upstream.
+        """
+        if not self.upstream:
+            return url
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        return urljoin(self.upstream, path)
+
+    def get(self, key, url):
+        """
+        Returns (metadata, image) of avatar, metadata has content_type and
+        etag of the image.
+
+        Stale cached avatar is served when upstream fails, UpstreamError is
+        raised when there's none.
+        """
+        cached = self.cache.get(key)
+        if cached is not None and \
+           time.time() - cached[0]['fetched'] < self.revalidate:
+            inc('avatar_requests', result='hit')
+            return cached
+
+        headers = {}
+        if cached is not None:
+            meta = cached[0]
+            if meta.get('upstream_etag'):
+                headers['If-None-Match'] = meta['upstream_etag']
+            if meta.get('upstream_modified'):
+                headers['If-Modified-Since'] = meta['upstream_modified']
+        try:
+            with timer('avatar_fetch'):
+                status, response_headers, body = self.pool.request(
+                    self.upstream_url(url), headers)
+            if status == 304 and cached is not None:
+                inc('avatar_requests', result='revalidated')
+                cached[0]['fetched'] = time.time()
+                self.cache.put(key, cached[0])
+                return cached
+            if status != 200:
+                raise UpstreamError('Upstream returned {0} for {1}'.format(
+                    status, url))
+        except UpstreamError:
+            if cached is None:
+                raise
+            log.warning('Serving stale avatar %s', key, exc_info=True)
+            inc('avatar_requests', result='stale')
+            return cached
+
+        inc('avatar_requests', result='miss')
+        meta = {
+            'content_type': response_headers.get(
+                'content-type', 'application/octet-stream'),
+            'etag': sha1(body).hexdigest(),
+            'upstream_etag': response_headers.get('etag'),
+            'upstream_modified': response_headers.get('last-modified'),
+            'fetched': time.time(),
+        }
+        self.cache.put(key, meta, body)
+        return meta, body
+
+
+_PROXIES = {}
+_LOCK = Lock()
+
+
+def get_avatar_proxy(directory, max_size, upstream=None, pool_size=4,
+                     timeout=5.0, revalidate=86400):
+    """
+    Returns AvatarProxy caching in given directory, one per process.
+    """
+    with _LOCK:
+        if directory not in _PROXIES:
+            _PROXIES[directory] = AvatarProxy(
+                AvatarCache(directory, max_size),
+                HTTPConnectionPool(pool_size, timeout),
+                upstream,
+                revalidate,
+            )
+        return _PROXIES[directory]
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends of presence data.
+
+Views talk to backend returned by utils.get_backend(). Every backend offers:
+ - `user_id in backend` and iteration over user ids,
+ - weekday_stats(user_id, first=None, last=None) returning seven
+   (count, interval sum, start sum, end sum) tuples,
+ - weekday_distribution(user_id, first=None, last=None) returning
+   store.WeekdayDistribution (ValueError without per-day entries),
+ - has_entries telling whether date ranges are supported,
+ - version and last_modified of the data.
+
+Default 'csv' backend is PresenceStore (or PresenceSummary) from
+utils.get_data(), 'sqlite' backend is SqliteBackend defined here.
+"""
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from Queue import Empty, Queue
+from threading import Lock
+
+from presence_analyzer.loader import file_version, parse_rows
+from presence_analyzer.store import WeekdayDistribution, weekday_of
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    weekday INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+WEEKDAY_STATS_SQL = """
+SELECT weekday, COUNT(*), SUM(end_time - start_time),
+       SUM(start_time), SUM(end_time)
+FROM presence
+WHERE user_id = ? AND day >= ? AND day <= ?
+GROUP BY weekday
+"""
+
+ENTRIES_SQL = """
+SELECT day, start_time, end_time
+FROM presence
+WHERE user_id = ? AND day >= ? AND day <= ?
+"""
+
+# date ordinals are positive and below 4e6, these bound any range
+_MIN_DAY, _MAX_DAY = 0, 10 ** 7
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of SQLite connections shared by threads of one process.
+    """
+    def __init__(self, path, size=5):
+        self.path = path
+        self._idle = Queue(maxsize=size)
+        for _ in range(size):
+            self._idle.put(None)
+
+    def _connect(self):
+        """
+        Opens new connection.
+        """
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.executescript(SCHEMA)
+        return connection
+
+    @contextmanager
+    def connection(self):
+        """
+        Lends connection for the duration of with block.
+
+        Waits when all connections are in use.
+        """
+        connection = self._idle.get()
+        try:
+            if connection is None:
+                connection = self._connect()
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def close(self):
+        """
+        Closes idle connections.
+        """
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                return
+            if connection is not None:
+                connection.close()
+
+
+class SqliteBackend(object):
+    """
+    Presence data stored in SQLite database, aggregated by SQL queries.
+    """
+    has_entries = True
+
+    def __init__(self, path, pool_size=5):
+        self.pool = ConnectionPool(path, pool_size)
+
+    def _meta(self, key):
+        """
+        Returns value from meta table or None.
+        """
+        with self.pool.connection() as connection:
+            row = connection.execute(
+                'SELECT value FROM meta WHERE key = ?', (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    @property
+    def version(self):
+        """
+        Version tag of CSV file imported last.
+        """
+        return self._meta('version')
+
+    @property
+    def last_modified(self):
+        """
+        Modification time of CSV file imported last.
+        """
+        value = self._meta('last_modified')
+        return datetime.utcfromtimestamp(int(value)) if value else None
+
+    def __contains__(self, user_id):
+        with self.pool.connection() as connection:
+            return connection.execute(
+                'SELECT 1 FROM presence WHERE user_id = ? LIMIT 1',
+                (user_id,)
+            ).fetchone() is not None
+
+    def __iter__(self):
+        with self.pool.connection() as connection:
+            user_ids = [
+                row[0] for row in connection.execute(
+                    'SELECT DISTINCT user_id FROM presence ORDER BY user_id')
+            ]
+        return iter(user_ids)
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns weekday stats of user computed by SQL aggregates.
+        """
+        result = [(0, 0, 0, 0)] * 7
+        with self.pool.connection() as connection:
+            rows = connection.execute(WEEKDAY_STATS_SQL, (
+                user_id,
+                _MIN_DAY if first is None else first,
+                _MAX_DAY if last is None else last,
+            )).fetchall()
+        for weekday, count, interval_sum, start_sum, end_sum in rows:
+            result[weekday] = (count, interval_sum, start_sum, end_sum)
+        return result
+
+    def weekday_distribution(self, user_id, first=None, last=None):
+        """
+        Returns WeekdayDistribution of user built from queried entries.
+        """
+        with self.pool.connection() as connection:
+            rows = connection.execute(ENTRIES_SQL, (
+                user_id,
+                _MIN_DAY if first is None else first,
+                _MAX_DAY if last is None else last,
+            )).fetchall()
+        return WeekdayDistribution(rows)
+
+
+def import_csv(db_path, csv_path):
+    """
+    Imports presence CSV file into SQLite database, replacing its content.
+
+    Returns number of imported rows.
+    """
+    connection = sqlite3.connect(db_path)
+    try:
+        connection.executescript(SCHEMA)
+        with open(csv_path, 'r') as csvfile, connection:
+            connection.execute('DELETE FROM presence')
+            cursor = connection.executemany(
+                'INSERT OR REPLACE INTO presence '
+                '(user_id, day, weekday, start_time, end_time) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (
+                    (user_id, day, weekday_of(day), start, end)
+                    for user_id, day, start, end in parse_rows(csvfile)
+                )
+            )
+            count = cursor.rowcount
+            stat = os.fstat(csvfile.fileno())
+            connection.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                [
+                    ('version', file_version(stat)[0]),
+                    ('last_modified', '{0:d}'.format(int(stat.st_mtime))),
+                ]
+            )
+    finally:
+        connection.close()
+    log.info('Imported %d rows from %s into %s', count, csv_path, db_path)
+    return count
+
+
+_BACKENDS = {}
+_LOCK = Lock()
+
+
+def get_sqlite_backend(path, pool_size=5):
+    """
+    Returns SqliteBackend of given database, one per process.
+    """
+    with _LOCK:
+        if path not in _BACKENDS:
+            _BACKENDS[path] = SqliteBackend(path, pool_size)
+        return _BACKENDS[path]
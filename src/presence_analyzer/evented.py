@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Event-driven server based on gevent (optional dependency).
+
+Every connection is served by a greenlet instead of a thread, so one
+process keeps thousands of concurrent connections open. Cached responses
+are answered straight from the event loop. Blocking work (presence data
+loading and computing of uncached responses) runs in a small pool of
+native threads registered as app.extensions['executor'], see
+utils.offload.
+"""
+from __future__ import unicode_literals
+
+try:
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    from gevent.threadpool import ThreadPool
+except ImportError:  # pragma: no cover
+    WSGIServer = None
+
+from presence_analyzer.utils import warm_caches
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def serve(app, host, port, connections=10000, threads=4):
+    """
+    Serves app until interrupted.
+
+    `connections` bounds number of concurrently served connections,
+    `threads` is size of executor pool. Caches are warmed before the server
+    starts listening.
+    """
+    if WSGIServer is None:
+        raise RuntimeError('Event-driven server requires gevent')
+    executor = ThreadPool(threads)
+    app.extensions['executor'] = executor
+    executor.apply(warm_caches)
+    server = WSGIServer((host, port), app, spawn=Pool(connections))
+    log.info('Serving on %s:%d, %d connections, %d threads',
+             host, port, connections, threads)
+    try:
+        server.serve_forever()
+    finally:
+        del app.extensions['executor']
+        executor.kill()
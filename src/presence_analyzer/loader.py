@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of presence CSV files.
+"""
+from __future__ import unicode_literals
+
+import csv
+import multiprocessing
+import os
+import threading
+from datetime import date, datetime
+from hashlib import sha1
+
+from presence_analyzer.metrics import inc, timer
+from presence_analyzer.snapshot import SnapshotError, read_snapshot
+from presence_analyzer.store import (
+    PresenceStore,
+    PresenceSummary,
+    seconds_since_midnight,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# offsets of separators in 'YYYY-MM-DD,HH:MM:SS,HH:MM:SS' after user id
+_SEPARATORS = ((4, '-'), (7, '-'), (10, ','), (13, ':'), (16, ':'),
+               (19, ','), (22, ':'), (25, ':'))
+# (start, end) of numbers in the same layout, all of them must be digits
+_NUMBERS = ((0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19),
+            (20, 22), (23, 25), (26, 28))
+_TAIL_LENGTH = 28
+# bytes from start and end of loaded part compared to detect rewrites
+FINGERPRINT_BLOCK = 4096
+
+
+def file_version(stat):
+    """
+    Returns (version tag, last modification datetime) of file from its stat.
+    """
+    identity = '{0.st_dev}:{0.st_ino}:{0.st_size}:{0.st_mtime!r}'.format(stat)
+    return (
+        sha1(identity.encode('ascii')).hexdigest()[:16],
+        datetime.utcfromtimestamp(int(stat.st_mtime)),
+    )
+
+
+def parse_row(row):
+    """
+    Converts CSV row to (user_id, date ordinal, start, end) tuple.
+
+    Start and end are expressed in seconds since midnight. Returns None for
+    header, footer and malformed rows.
+    """
+    if len(row) != 4:
+        # ignore header and footer lines
+        return None
+    try:
+        user_id = int(row[0])
+        day = datetime.strptime(row[1], '%Y-%m-%d').date()
+        start = datetime.strptime(row[2], '%H:%M:%S').time()
+        end = datetime.strptime(row[3], '%H:%M:%S').time()
+    except (ValueError, TypeError):
+        log.debug('Problem with row %r: ', row, exc_info=True)
+        return None
+    return (
+        user_id,
+        day.toordinal(),
+        seconds_since_midnight(start),
+        seconds_since_midnight(end),
+    )
+
+
+def _parse_clock(text, offset):
+    """
+    Parses 'HH:MM:SS' starting at offset. Returns None when out of range.
+    """
+    hours = int(text[offset:offset + 2])
+    minutes = int(text[offset + 3:offset + 5])
+    seconds = int(text[offset + 6:offset + 8])
+    if hours > 23 or minutes > 59 or seconds > 59:
+        return None
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_line(line, ordinals):
+    """
+    Parses line in fixed 'id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS' layout by slicing.
+
+    Returns None when line doesn't match the layout exactly, caller should
+    fall back to parse_row then. `ordinals` caches date ordinals by text,
+    as the same dates repeat for every user.
+    """
+    line = line.rstrip(str('\r\n'))
+    comma = line.find(',')
+    if comma < 1 or len(line) - comma - 1 != _TAIL_LENGTH:
+        return None
+    tail = line[comma + 1:]
+    for offset, separator in _SEPARATORS:
+        if tail[offset] != separator:
+            return None
+    for start, end in _NUMBERS:
+        # int() would accept signs and spaces strptime rejects
+        if not tail[start:end].isdigit():
+            return None
+    try:
+        user_id = int(line[:comma])
+        day = tail[:10]
+        ordinal = ordinals.get(day)
+        if ordinal is None:
+            ordinal = ordinals[day] = date(
+                int(day[:4]), int(day[5:7]), int(day[8:10])
+            ).toordinal()
+        start = _parse_clock(tail, 11)
+        end = _parse_clock(tail, 20)
+    except ValueError:
+        return None
+    if start is None or end is None:
+        return None
+    return user_id, ordinal, start, end
+
+
+def parse_rows(lines, fast=True):
+    """
+    Yields (user_id, date ordinal, start, end) tuples from CSV lines.
+
+    Regular lines are parsed with parse_line, the rest (and every line when
+    `fast` is False) goes through csv module and parse_row.
+    """
+    counts = {True: 0, False: 0}
+    try:
+        if not fast:
+            for row in csv.reader(lines, delimiter=str(',')):
+                parsed = parse_row(row)
+                counts[parsed is not None] += 1
+                if parsed is not None:
+                    yield parsed
+            return
+
+        ordinals = {}
+        for line in lines:
+            parsed = parse_line(line, ordinals)
+            if parsed is None:
+                for row in csv.reader([line], delimiter=str(',')):
+                    parsed = parse_row(row)
+            counts[parsed is not None] += 1
+            if parsed is not None:
+                yield parsed
+    finally:
+        inc('rows_parsed', counts[True])
+        inc('rows_skipped', counts[False])
+
+
+def load_store(path, fast=True):
+    """
+    Reads presence CSV file into PresenceStore.
+    """
+    with open(path, 'r') as csvfile:
+        return PresenceStore.from_rows(parse_rows(csvfile, fast))
+
+
+def split_file(path, chunks):
+    """
+    Splits file into at most `chunks` byte ranges aligned to line ends.
+
+    Returns list of (start, end) offsets covering the whole file.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as csvfile:
+        for i in range(1, chunks):
+            position = max(size * i // chunks, bounds[-1])
+            if position >= size:
+                break
+            csvfile.seek(position)
+            csvfile.readline()
+            if csvfile.tell() >= size:
+                break
+            if csvfile.tell() > bounds[-1]:
+                bounds.append(csvfile.tell())
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _load_chunk(task):
+    """
+    Parses complete lines of byte range of the file into PresenceStore.
+
+    Runs in worker process. Returns the store and offset where the complete
+    lines end.
+    """
+    path, start, end, fast = task
+    with open(path, 'r') as csvfile:
+        csvfile.seek(start)
+        chunk = csvfile.read(end - start)
+    complete = chunk[:chunk.rfind(str('\n')) + 1]
+    rows = parse_rows(complete.splitlines(True), fast)
+    return PresenceStore.from_rows(rows), start + len(complete)
+
+
+def load_store_parallel(path, workers, fast=True, chunks_per_worker=4):
+    """
+    Parses file in a pool of worker processes.
+
+    The file is split into newline-aligned byte ranges, every range is
+    parsed into PresenceStore and the results are combined by user_id.
+    Returns the store and offset where the complete lines end; unfinished
+    last line is left for the caller.
+    """
+    tasks = [
+        (path, start, end, fast)
+        for start, end in split_file(path, workers * chunks_per_worker)
+    ]
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_load_chunk, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    if not results:
+        return PresenceStore.from_rows([]), 0
+    store = PresenceStore.combine([chunk for chunk, _ in results])
+    return store, results[-1][1]
+
+
+def load_summary(path, fast=True):
+    """
+    Streams presence CSV file into PresenceSummary.
+
+    Rows are folded into per-user weekday stats as they are read, so memory
+    use is O(users), not O(rows).
+    """
+    with open(path, 'r') as csvfile:
+        summary = PresenceSummary.from_rows(parse_rows(csvfile, fast))
+        summary.version, summary.last_modified = file_version(
+            os.fstat(csvfile.fileno()))
+    return summary
+
+
+class IncrementalLoader(object):
+    """
+    Loads append-only presence CSV file, parsing only newly appended rows.
+
+    Remembers byte offset and identity (inode, size, mtime) of the file from
+    the last load, together with fingerprint of the first and last block of
+    already loaded bytes. The file is re-read from scratch when it was
+    replaced, truncated or when loaded bytes changed (rewritten in place).
+    The fingerprint isn't known right after seed(), so rewrite of the file
+    before first load of seeded loader goes unnoticed unless it shrinks.
+
+    Full reloads are split between `workers` processes when there is more
+    than one, but only while the process runs a single thread (startup,
+    `bin/flask-ctl snapshot`, pre-fork master): child forked from threaded
+    process may deadlock on lock (e.g. of logging) held by another thread.
+
+    Loads are serialized by the loader's own lock, as callers (cache warm-up,
+    reloads by watcher) don't share one.
+    """
+    def __init__(self, path, fast=True, workers=1):
+        self.path = path
+        self.fast = fast
+        self.workers = workers
+        self.store = None
+        self._base = None  # store built from complete lines only
+        self._identity = None
+        self._offset = 0
+        self._fingerprint = None
+        self._lock = threading.Lock()
+
+    def checkpoint(self):
+        """
+        Returns (store, offset, identity) describing complete lines loaded.
+        """
+        with self._lock:
+            base = self._base.flatten() if self._base is not None else None
+            return base, self._offset, self._identity
+
+    def seed(self, store, offset, identity):
+        """
+        Restores state saved by checkpoint, e.g. from snapshot file.
+        """
+        with self._lock:
+            self._base = self.store = store
+            self._offset = offset
+            self._fingerprint = None
+            if identity[2] != offset:
+                # unfinished last line wasn't included, make load() read it
+                identity = identity[:2] + (offset, None)
+            self._identity = identity
+
+    def _read_fingerprint(self, offset):
+        """
+        Returns digest of first and last block of file before offset.
+        """
+        with open(self.path, 'rb') as csvfile:
+            head = csvfile.read(min(offset, FINGERPRINT_BLOCK))
+            csvfile.seek(max(offset - FINGERPRINT_BLOCK, 0))
+            tail = csvfile.read(offset - csvfile.tell())
+        return sha1(head + tail).hexdigest()
+
+    def _changed(self, stat):
+        """
+        Tells whether already loaded part of the file is different now.
+        """
+        if stat.st_dev != self._identity[0] \
+           or stat.st_ino != self._identity[1] \
+           or stat.st_size <= self._identity[2]:
+            return True
+        return self._fingerprint is not None and \
+            self._fingerprint != self._read_fingerprint(self._offset)
+
+    def load(self):
+        """
+        Returns PresenceStore reflecting current content of the file.
+        """
+        with self._lock:
+            stat = os.stat(self.path)
+            identity = (stat.st_dev, stat.st_ino, stat.st_size,
+                        stat.st_mtime)
+            if self._identity is not None:
+                if identity == self._identity:
+                    return self.store
+                if self._changed(stat):
+                    log.info('%s was replaced, truncated or rewritten, '
+                             'reloading', self.path)
+                    self._base = None
+            kind = 'incremental' if self._base is not None else 'full'
+            with timer('data_load', kind=kind):
+                return self._load(stat, identity)
+
+    def _load(self, stat, identity):
+        """
+        Reads the file from remembered offset and merges parsed rows.
+        """
+        if self._base is None:
+            self._offset = 0
+            if self.workers > 1 and threading.active_count() == 1:
+                self._base, self._offset = load_store_parallel(
+                    self.path, self.workers, self.fast)
+            elif self.workers > 1:
+                log.info('Threads are running, parsing %s in process',
+                         self.path)
+
+        with open(self.path, 'r') as csvfile:
+            csvfile.seek(self._offset)
+            chunk = csvfile.read()
+        # last line may still be written to, keep it out of the base store
+        complete = chunk[:chunk.rfind(str('\n')) + 1]
+        partial = chunk[len(complete):]
+
+        rows = parse_rows(complete.splitlines(True), self.fast)
+        if self._base is None:
+            self._base = PresenceStore.from_rows(rows)
+        else:
+            self._base = self._base.merge(rows)
+        self._offset += len(complete)
+        self._fingerprint = self._read_fingerprint(self._offset)
+        self.store = self._base
+        if partial:
+            self.store = self._base.merge(parse_rows([partial], self.fast))
+        self.store.version, self.store.last_modified = file_version(stat)
+        self._identity = identity
+        return self.store
+
+
+_LOADERS = {}
+_LOCK = threading.Lock()
+
+
+def get_loader(path, snapshot=None, workers=1):
+    """
+    Returns IncrementalLoader of given file, creating it on first use.
+
+    New loader starts from snapshot file when one is given and can be read,
+    then only rows appended since the snapshot was taken are parsed.
+    """
+    with _LOCK:
+        if path not in _LOADERS:
+            loader = IncrementalLoader(path, workers=workers)
+            if snapshot and os.path.exists(snapshot):
+                try:
+                    loader.seed(*read_snapshot(snapshot))
+                except SnapshotError:
+                    log.warning('Ignoring snapshot %s', snapshot,
+                                exc_info=True)
+            _LOADERS[path] = loader
+        return _LOADERS[path]
@@ -5,5 +5,8 @@ Flask app initialization.
 from flask import Flask
 from flask_mako import MakoTemplates
 
+from presence_analyzer import profiling
+
 app = Flask(__name__)  # pylint: disable=invalid-name
 MakoTemplates(app)
+profiling.init_app(app)
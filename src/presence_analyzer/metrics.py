@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and timers of hot paths, exported in Prometheus text format.
+"""
+from __future__ import unicode_literals
+
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from flask import g, has_request_context
+
+PREFIX = 'presence_analyzer_'
+
+
+def _format_labels(labels):
+    """
+    Formats sorted (name, value) pairs as Prometheus label set.
+    """
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(
+            name,
+            unicode(value).replace('\\', '\\\\').replace('"', '\\"'),
+        )
+        for name, value in labels
+    ))
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of counters and timers.
+
+    Timers keep count and sum of observed durations, like Prometheus
+    summary without quantiles.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._timers = {}
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records duration of timed operation.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            count, total = self._timers.get(key, (0, 0.0))
+            self._timers[key] = (count + 1, total + seconds)
+
+    def reset(self):
+        """
+        Forgets all recorded values.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def render(self):
+        """
+        Returns metrics in Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted(self._timers.items())
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            metric = '{0}{1}_total'.format(PREFIX, name)
+            if metric not in declared:
+                declared.add(metric)
+                lines.append('# TYPE {0} counter'.format(metric))
+            lines.append('{0}{1} {2}'.format(
+                metric, _format_labels(labels), value))
+        for (name, labels), (count, total) in timers:
+            metric = '{0}{1}_seconds'.format(PREFIX, name)
+            if metric not in declared:
+                declared.add(metric)
+                lines.append('# TYPE {0} summary'.format(metric))
+            lines.append('{0}_count{1} {2}'.format(
+                metric, _format_labels(labels), count))
+            lines.append('{0}_sum{1} {2!r}'.format(
+                metric, _format_labels(labels), total))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def inc(name, value=1, **labels):
+    """
+    Increments counter of default registry.
+    """
+    METRICS.inc(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    """
+    Records duration in default registry and in timings of current request.
+    """
+    METRICS.observe(name, seconds, **labels)
+    if has_request_context():
+        timings = g.setdefault('server_timing', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Measures duration of with block, see observe.
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - started, **labels)
+
+
+def server_timing_header():
+    """
+    Returns Server-Timing header value of current request or None.
+    """
+    timings = g.get('server_timing')
+    if not timings:
+        return None
+    return ', '.join(
+        '{0};dur={1:.3f}'.format(name, seconds * 1000)
+        for name, seconds in sorted(timings.items())
+    )
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-fork multi-process server.
+
+Master process loads presence data and users directory, then forks worker
+processes serving requests from shared listening socket. Workers inherit
+loaded data, whose arrays stay shared copy-on-write. When DATA_CSV changes
+master loads it again and replaces workers one by one, each new worker is
+forked with fresh data before an old one is stopped.
+
+Signals of master: TERM and INT stop workers gracefully and exit, HUP
+replaces workers.
+"""
+from __future__ import unicode_literals
+
+import errno
+import os
+import signal
+import socket
+import time
+
+from werkzeug.serving import BaseWSGIServer
+
+from presence_analyzer.utils import warm_caches
+from presence_analyzer.watcher import file_identity
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def listen(host, port, backlog=128):
+    """
+    Returns bound listening socket shared by workers.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class Worker(object):
+    """
+    Serves requests one at a time until asked to stop by TERM signal.
+
+    Request in progress is always completed before exit.
+    """
+    def __init__(self, app, sock, timeout=1.0):
+        self.server = BaseWSGIServer(
+            *sock.getsockname()[:2], app=app, fd=sock.fileno())
+        self.server.timeout = timeout
+        self.stopping = False
+
+    def stop(self, *_):
+        """
+        Signal handler asking worker to stop.
+        """
+        self.stopping = True
+
+    def run(self):
+        """
+        Handles requests until stopped.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        while not self.stopping:
+            self.server.handle_request()
+
+
+class Master(object):
+    """
+    Keeps given number of workers running, restarting them when presence
+    data changes.
+    """
+    def __init__(self, app, sock, workers=2, check_interval=5.0):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.check_interval = check_interval
+        self.pids = set()
+        self.stopping = False
+        self.reload_requested = False
+
+    def preload(self):
+        """
+        Loads data which workers inherit.
+        """
+        warm_caches()
+
+    def spawn(self):
+        """
+        Forks new worker, returns its pid.
+        """
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                Worker(self.app, self.sock).run()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Worker %d failed', os.getpid())
+                status = 1
+            finally:
+                os._exit(status)  # pylint: disable=protected-access
+        self.pids.add(pid)
+        log.info('Started worker %d', pid)
+        return pid
+
+    def kill(self, pid):
+        """
+        Stops worker gracefully and waits for it.
+        """
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+        self._wait(pid, 0)
+
+    def _wait(self, pid, options):
+        """
+        Waits for worker, retrying interrupted calls.
+
+        Returns pid of exited worker, 0 when none has exited.
+        """
+        while True:
+            try:
+                pid = os.waitpid(pid, options)[0]
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            self.pids.discard(pid)
+            return pid
+
+    def reap(self):
+        """
+        Forgets exited workers.
+        """
+        while self._wait(-1, os.WNOHANG):
+            pass
+
+    def restart(self):
+        """
+        Replaces running workers one by one.
+        """
+        for pid in list(self.pids):
+            self.spawn()
+            self.kill(pid)
+            log.info('Replaced worker %d', pid)
+
+    def _stop(self, *_):
+        """
+        Signal handler asking master to stop.
+        """
+        self.stopping = True
+
+    def _reload(self, *_):
+        """
+        Signal handler asking master to replace workers.
+        """
+        self.reload_requested = True
+
+    def run(self):
+        """
+        Preloads data and manages workers until stopped.
+        """
+        path = self.app.config['DATA_CSV']
+        identity = file_identity(path)
+        self.preload()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        try:
+            while not self.stopping:
+                self.reap()
+                while len(self.pids) < self.workers:
+                    self.spawn()
+                current = file_identity(path)
+                if current != identity or self.reload_requested:
+                    identity = current
+                    self.reload_requested = False
+                    log.info('Reloading %s', path)
+                    self.preload()
+                    self.restart()
+                time.sleep(self.check_interval)
+        finally:
+            for pid in list(self.pids):
+                self.kill(pid)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand profiling of single requests.
+
+When PROFILING_ENABLED is set, request with `X-Profile: 1` header or
+`_profile=1` query parameter runs under cProfile. Stats are dumped to
+PROFILES_DIR as <name>.prof (pstats) and <name>.txt (top functions).
+"""
+from __future__ import unicode_literals
+
+import cProfile
+import os
+import pstats
+import re
+import time
+from StringIO import StringIO
+
+from flask import current_app, g, request
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+HEADER = 'X-Profile'
+QUERY_PARAM = '_profile'
+
+
+def should_profile():
+    """
+    Tells whether current request asked for profiling and it's enabled.
+    """
+    if not current_app.config.get('PROFILING_ENABLED'):
+        return False
+    return request.headers.get(HEADER) == '1' or \
+        request.args.get(QUERY_PARAM) == '1'
+
+
+def summarize(stats, top=30, sort='cumulative'):
+    """
+    Returns text summary of top functions of pstats.Stats.
+    """
+    output = StringIO()
+    stats.stream = output
+    stats.sort_stats(sort).print_stats(top)
+    return output.getvalue()
+
+
+def save_profile(profiler, directory, endpoint, top=30):
+    """
+    Dumps profiler stats and their summary to directory.
+
+    Returns name of the profile (file names without extension).
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    now = time.time()
+    name = '{0}.{1:06d}-{2}-{3}'.format(
+        time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+        int(now % 1 * 1000000),
+        re.sub(r'[^\w.-]', '_', endpoint or 'unknown'),
+        os.getpid(),
+    )
+    path = os.path.join(directory, name)
+    stats = pstats.Stats(profiler)
+    stats.dump_stats(path + '.prof')
+    with open(path + '.txt', 'w') as summary:
+        summary.write(summarize(stats, top))
+    return name
+
+
+def list_profiles(directory):
+    """
+    Returns (name, modification time, size) of captured profiles, newest
+    first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    result = []
+    for filename in os.listdir(directory):
+        if not filename.endswith('.prof'):
+            continue
+        stat = os.stat(os.path.join(directory, filename))
+        result.append((filename[:-len('.prof')], stat.st_mtime, stat.st_size))
+    return sorted(result, key=lambda item: item[1], reverse=True)
+
+
+def start_profiler():
+    """
+    Starts profiling current request when requested.
+    """
+    if should_profile():
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def stop_profiler():
+    """
+    Stops profiler of current request and saves its stats.
+
+    Returns name of saved profile, None when request isn't profiled.
+    """
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return None
+    profiler.disable()
+    name = save_profile(
+        profiler,
+        current_app.config['PROFILES_DIR'],
+        request.endpoint,
+        current_app.config.get('PROFILING_TOP', 30),
+    )
+    log.info('Profile of %s saved as %s', request.path, name)
+    return name
+
+
+def add_profile_header(response):
+    """
+    Saves profile and returns its name in X-Profile-Id response header.
+    """
+    name = stop_profiler()
+    if name is not None:
+        response.headers['X-Profile-Id'] = name
+    return response
+
+
+def save_failed_profile(_):
+    """
+    Saves profile of request which raised before its response was built.
+    """
+    stop_profiler()
+
+
+def init_app(app):
+    """
+    Registers request hooks profiling requests which ask for it.
+
+    Hooks are registered before others, so profile covers them too.
+    """
+    app.before_request(start_profiler)
+    app.after_request(add_profile_header)
+    app.teardown_request(save_failed_profile)
@@ -41,10 +41,16 @@ def download_users():
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, watch=True):
     from presence_analyzer import app
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if app.config.get('CACHE_WARM_ON_STARTUP'):
+        from presence_analyzer.utils import warm_caches
+        warm_caches()
+    if watch and app.config.get('WATCH_FILES'):
+        from presence_analyzer.utils import watch_files
+        watch_files()
     return app
 
 
@@ -115,6 +121,83 @@ def run():
         """Serve the debugging application."""
         _serve(action, debug=True, dry_run=dry_run)
 
+    # bin/flask-ctl serve_async
+    def action_serve_async(host=('h', '0.0.0.0'), port=('p', 6789),
+                           config=('c', DEPLOY_CFG)):
+        """Serve the application by event-driven gevent server.
+
+        Number of connections and of executor threads are configured by
+        ASYNC_CONNECTIONS and ASYNC_THREADS settings.
+        """
+        from presence_analyzer.evented import serve
+        app = make_app(config=config)
+        serve(
+            app, host, port,
+            app.config.get('ASYNC_CONNECTIONS', 10000),
+            app.config.get('ASYNC_THREADS', 4),
+        )
+
+    # bin/flask-ctl serve_prefork
+    def action_serve_prefork(host=('h', '0.0.0.0'), port=('p', 6789),
+                             config=('c', DEPLOY_CFG)):
+        """Serve the application by pre-forked worker processes.
+
+        Number of workers and interval of DATA_CSV checks are configured
+        by PREFORK_WORKERS and PREFORK_CHECK_INTERVAL settings.
+        """
+        from presence_analyzer.prefork import Master, listen
+        # master watches DATA_CSV itself, threads would not survive fork
+        app = make_app(config=config, watch=False)
+        Master(
+            app, listen(host, port),
+            app.config.get('PREFORK_WORKERS', 4),
+            app.config.get('PREFORK_CHECK_INTERVAL', 5.0),
+        ).run()
+
+    # bin/flask-ctl snapshot
+    def action_snapshot(config=('c', DEPLOY_CFG)):
+        """Parse DATA_CSV and write binary snapshot to DATA_SNAPSHOT."""
+        from flask.config import Config
+        from presence_analyzer.loader import IncrementalLoader
+        from presence_analyzer.snapshot import write_snapshot
+        cfg = Config(abspath())
+        cfg.from_pyfile(abspath(config))
+        loader = IncrementalLoader(cfg['DATA_CSV'],
+                                   workers=cfg.get('LOADER_WORKERS', 1))
+        loader.load()
+        write_snapshot(cfg['DATA_SNAPSHOT'], *loader.checkpoint())
+        print 'Snapshot written to', cfg['DATA_SNAPSHOT']
+
+    # bin/flask-ctl import_sqlite
+    def action_import_sqlite(config=('c', DEPLOY_CFG)):
+        """Import DATA_CSV into SQLITE_DB database."""
+        from flask.config import Config
+        from presence_analyzer.backends import import_csv
+        cfg = Config(abspath())
+        cfg.from_pyfile(abspath(config))
+        count = import_csv(cfg['SQLITE_DB'], cfg['DATA_CSV'])
+        print count, 'rows imported to', cfg['SQLITE_DB']
+
+    # bin/flask-ctl profiles [name]
+    def action_profiles(name='', top=('t', 30), sort=('s', 'cumulative'),
+                        config=('c', DEPLOY_CFG)):
+        """List captured request profiles or summarize the given one."""
+        import pstats
+        import time
+        from flask.config import Config
+        from presence_analyzer.profiling import list_profiles, summarize
+        cfg = Config(abspath())
+        cfg.from_pyfile(abspath(config))
+        directory = cfg['PROFILES_DIR']
+        if name:
+            stats = pstats.Stats(os.path.join(directory, name + '.prof'))
+            print summarize(stats, top, sort)
+            return
+        for name, mtime, size in list_profiles(directory):
+            print '{0}  {1}  {2:>9}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime)),
+                name, size)
+
     # bin/flask-ctl status
     def action_status(dry_run=False):
         """Status of the application."""
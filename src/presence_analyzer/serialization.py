@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+JSON serialization and compression of responses.
+"""
+from __future__ import unicode_literals
+
+import json
+import zlib
+
+from flask import current_app, has_app_context, request
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SERIALIZERS = {'json': json.dumps}
+try:
+    import ujson
+    SERIALIZERS['ujson'] = ujson.dumps
+except ImportError:  # pragma: no cover
+    pass
+try:
+    import simplejson
+    SERIALIZERS['simplejson'] = simplejson.dumps
+except ImportError:  # pragma: no cover
+    pass
+
+# fastest first
+PREFERRED = ('ujson', 'simplejson', 'json')
+
+# zlib window bits of supported content encodings
+ENCODINGS = (
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS),
+)
+
+
+class Payload(bytes):
+    """
+    Already encoded JSON document, jsonify sends it as is.
+    """
+
+
+def get_serializer():
+    """
+    Returns dumps function chosen by JSON_SERIALIZER setting.
+
+    'auto' (default, also outside of application context) picks the
+    fastest installed encoder, falling back to stdlib json.
+    """
+    name = 'auto'
+    if has_app_context():
+        name = current_app.config.get('JSON_SERIALIZER', name)
+    if name == 'auto':
+        name = next(name for name in PREFERRED if name in SERIALIZERS)
+    elif name not in SERIALIZERS:
+        log.warning('JSON serializer %s is not available, using json', name)
+        name = 'json'
+    return SERIALIZERS[name]
+
+
+def dumps(value):
+    """
+    Serializes value with configured serializer.
+    """
+    return get_serializer()(value)
+
+
+def negotiate_encoding():
+    """
+    Returns content encoding accepted by client or None.
+    """
+    if not current_app.config.get('COMPRESSION', True):
+        return None
+    for encoding, _ in ENCODINGS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def _compressor(encoding):
+    """
+    Returns zlib compressor producing given content encoding.
+    """
+    wbits = dict(ENCODINGS)[encoding]
+    return zlib.compressobj(6, zlib.DEFLATED, wbits)
+
+
+def compress(data, encoding):
+    """
+    Compresses data with given content encoding.
+    """
+    compressor = _compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    """
+    Compresses iterable of chunks lazily.
+    """
+    compressor = _compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compressible(mimetype):
+    """
+    Tells whether responses of given mimetype are worth compressing.
+    """
+    return mimetype == 'application/json' or mimetype.startswith('text/')
+
+
+def compress_response(response, variants=None):
+    """
+    Compresses response body when client accepts it.
+
+    Only JSON and text responses built in memory or streamed by views are
+    compressed, files sent by send_file (direct_passthrough) are not.
+    Bodies smaller than COMPRESS_MIN_SIZE are left alone, streamed bodies
+    are always compressed on the fly. Strong ETag gets encoding suffix, as
+    the compressed representation differs. Optional `variants` dict keeps
+    compressed bodies by encoding between calls.
+    """
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.direct_passthrough or not compressible(response.mimetype):
+        # files are sent as they are, with their length and ranges
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+    # ranges and length of identity body don't apply to compressed one
+    response.headers.pop('Accept-Ranges', None)
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config.get('COMPRESS_MIN_SIZE', 1024):
+            return response
+        if variants is None:
+            variants = {}
+        if encoding not in variants:
+            variants[encoding] = compress(data, encoding)
+        response.set_data(variants[encoding])
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag('{0}-{1}'.format(etag, encoding))
+    return response
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped binary snapshots of parsed presence data.
+
+Snapshot consists of header followed by little-endian arrays, each aligned
+to 8 bytes: user_ids (int64), bounds (int64), weekday index (int64, 7 x 4
+per user), dates, starts and ends (int32). Processes mapping the same file
+share its pages.
+"""
+from __future__ import unicode_literals
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from datetime import datetime
+
+from presence_analyzer.store import PresenceStore
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MAGIC = b'PASNAP\x00\x00'
+FORMAT_VERSION = 1
+
+# magic, format version, users, entries, offset, source device, inode,
+# size, mtime, data version tag, last modified timestamp
+_HEADER = struct.Struct(str('<8sIIQQqqqd16sq'))
+_STATS_PER_USER = 7 * 4
+
+
+class SnapshotError(Exception):
+    """
+    Snapshot file is missing, corrupted or in unsupported format.
+    """
+
+
+def _align(offset):
+    """
+    Rounds offset up to multiple of 8.
+    """
+    return (offset + 7) & ~7
+
+
+class MappedArray(object):
+    """
+    Read-only sequence of integers stored in memory-mapped buffer.
+
+    Slices are returned as copies (array or list), items are unpacked on
+    access, so the buffer itself is never copied as a whole.
+    """
+    def __init__(self, buf, offset, length, fmt):
+        self._buf = buf
+        self._offset = offset
+        self._length = length
+        self._fmt = fmt
+        self._item = struct.Struct(str('<' + fmt))
+
+    def __len__(self):
+        return self._length
+
+    def _slice(self, start, stop):
+        """
+        Returns items from start to stop as a new sequence.
+        """
+        size = self._item.size
+        if stop <= start:
+            return array(str(self._fmt)) if self._fmt == 'i' else []
+        raw = self._buf[self._offset + start * size:self._offset + stop * size]
+        if self._fmt == 'i':
+            items = array(b'i', raw)
+            if sys.byteorder != 'little':
+                items.byteswap()
+            return items
+        return list(struct.unpack(str('<{0}{1}'.format(stop - start,
+                                                       self._fmt)), raw))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step != 1:
+                raise ValueError('Extended slices are not supported')
+            return self._slice(start, stop)
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError('MappedArray index out of range')
+        return self._item.unpack_from(
+            self._buf, self._offset + key * self._item.size)[0]
+
+    def __iter__(self):
+        chunk = 4096
+        for start in xrange(0, self._length, chunk):
+            for item in self._slice(start, min(start + chunk, self._length)):
+                yield item
+
+
+def write_snapshot(path, store, offset, identity):
+    """
+    Writes store loaded from first `offset` bytes of file with given identity
+    (device, inode, size, mtime) to snapshot file at path.
+
+    File is written next to target and renamed, so readers never see
+    partially written snapshot.
+    """
+    users = len(store.user_ids)
+    entries = len(store.dates)
+    index = []
+    for user_id in store.user_ids:
+        for stats in store.weekday_index[user_id]:
+            index.extend(stats)
+    sections = [
+        struct.pack(str('<{0}q'.format(users)), *store.user_ids),
+        struct.pack(str('<{0}q'.format(users + 1)), *store.bounds),
+        struct.pack(str('<{0}q'.format(len(index))), *index),
+    ]
+    for values in (store.dates, store.starts, store.ends):
+        values = array(b'i', values)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        sections.append(values.tostring())
+
+    last_modified = store.last_modified or datetime.utcfromtimestamp(0)
+    header = _HEADER.pack(
+        MAGIC, FORMAT_VERSION, users, entries, offset,
+        identity[0], identity[1], identity[2], identity[3],
+        (store.version or '').encode('ascii'),
+        int((last_modified - datetime.utcfromtimestamp(0)).total_seconds()),
+    )
+    tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as output:
+        output.write(header)
+        position = len(header)
+        for section in sections:
+            padding = _align(position) - position
+            output.write(b'\x00' * padding)
+            output.write(section)
+            position += padding + len(section)
+    os.rename(tmp_path, path)
+
+
+def read_snapshot(path):
+    """
+    Maps snapshot file read-only.
+
+    Returns (store, offset, identity) as passed to write_snapshot.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            buf = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError) as error:
+        raise SnapshotError('Cannot map {0}: {1}'.format(path, error))
+    if len(buf) < _HEADER.size:
+        raise SnapshotError('{0} is too short'.format(path))
+    (magic, format_version, users, entries, offset, device, inode, size,
+     mtime, version, last_modified) = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise SnapshotError(
+            '{0} has unsupported format {1!r} {2}'.format(
+                path, magic, format_version)
+        )
+
+    position = _HEADER.size
+    arrays = []
+    for length, fmt in ((users, 'q'), (users + 1, 'q'),
+                        (users * _STATS_PER_USER, 'q'),
+                        (entries, 'i'), (entries, 'i'), (entries, 'i')):
+        position = _align(position)
+        arrays.append(MappedArray(buf, position, length, fmt))
+        position += length * struct.calcsize(str(fmt))
+    if position > len(buf):
+        raise SnapshotError('{0} is truncated'.format(path))
+
+    user_ids, bounds, index, dates, starts, ends = arrays
+    index = index[:]
+    weekday_index = dict(
+        (user_id, [
+            tuple(index[start:start + 4])
+            for start in xrange(i * _STATS_PER_USER,
+                                (i + 1) * _STATS_PER_USER, 4)
+        ])
+        for i, user_id in enumerate(user_ids)
+    )
+    store = PresenceStore(user_ids, bounds, dates, starts, ends,
+                          weekday_index)
+    store.shared = True
+    store.version = version.rstrip(b'\x00').decode('ascii') or None
+    store.last_modified = datetime.utcfromtimestamp(last_modified)
+    return store, offset, (device, inode, size, mtime)
@@ -1,8 +1,54 @@
 var app = {
-    user_id_changed: function (selected_user, chart_div) {}
+    user_id_changed: function (selected_user, chart_div) {},
+    // dashboards are kept in sessionStorage for this long (ms)
+    dashboard_max_age: 5 * 60 * 1000,
+    dashboards: {}
 };
 (function ($, app) {
     'use strict';
+
+    function storage_key(user_id) {
+        return 'presence_analyzer.dashboard.' + user_id;
+    }
+
+    function load_stored(user_id) {
+        var stored;
+        try {
+            stored = JSON.parse(window.sessionStorage.getItem(storage_key(user_id)));
+        } catch (e) {
+            return null;
+        }
+        if (!stored || new Date().getTime() - stored.time > app.dashboard_max_age) {
+            return null;
+        }
+        return stored.result;
+    }
+
+    function store(user_id, result) {
+        try {
+            window.sessionStorage.setItem(storage_key(user_id), JSON.stringify({
+                time: new Date().getTime(),
+                result: result
+            }));
+        } catch (e) {
+            // storage disabled or full, memory cache still works
+        }
+    }
+
+    // Returns promise of dashboard (name, avatar and all chart series) of
+    // user, fetched once and shared by all pages of the session.
+    app.dashboard = function (user_id, api_url) {
+        var result = app.dashboards[user_id] || load_stored(user_id);
+        if (result) {
+            app.dashboards[user_id] = result;
+            return $.Deferred().resolve(result).promise();
+        }
+        return $.getJSON(api_url + user_id, function (result) {
+            app.dashboards[user_id] = result;
+            store(user_id, result);
+        });
+    };
+
     $(function () {
         $("li > a[href='" + window.location.pathname + "']").parent().addClass("selected");
         var loading = $('#loading'),
@@ -15,8 +61,7 @@ var app = {
             $.each(result, function (i, item) {
                 dropdown.append($("<option />")
                     .val(item.user_id)
-                    .text(item.name)
-                    .attr("data-avatar-url", item.avatar_url));
+                    .text(item.name));
             });
             dropdown.show();
             loading.hide();
@@ -24,20 +69,23 @@ var app = {
 
         $('#user_id').change(function () {
             var selected_user = $(this).find(":selected"),
-                user_id = selected_user.val(),
-                avatar_url = selected_user.data('avatar-url');
+                user_id = selected_user.val();
             if (user_id) {
                 loading.show();
                 chart_div.hide();
                 no_data.hide();
                 avatar.hide();
-                app.user_id_changed(user_id, chart_div)
+                app.dashboard(user_id, chart_div.data("api-url"))
+                    .done(function (result) {
+                        app.user_id_changed(result, chart_div);
+                    })
                     .fail(function () {
                         no_data.show();
                     })
-                    .complete(function () {
+                    .always(function () {
                         loading.hide();
-                        avatar.attr("src", avatar_url);
+                        // served by local caching proxy
+                        avatar.attr("src", avatar.data("api-url") + user_id);
                         avatar.show();
                     });
             }
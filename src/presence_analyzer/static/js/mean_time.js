@@ -8,22 +8,20 @@ google.load("visualization", "1", {packages: ["corechart"], 'language': 'pl'});
             return result;
         }
 
-        app.user_id_changed = function (selected_user, chart_div) {
-            return $.getJSON(chart_div.data("api-url") + selected_user, function (result) {
-                $.each(result, function (i, value) {
-                    value[1] = parseInterval(value[1]);
-                });
-                var data = new google.visualization.DataTable(),
-                    options = { hAxis: {title: 'Weekday'} },
-                    formatter = new google.visualization.DateFormat({pattern: 'HH:mm:ss'}),
-                    chart = new google.visualization.ColumnChart(chart_div[0]);
-                data.addColumn('string', 'Weekday');
-                data.addColumn('datetime', 'Mean time (h:m:s)');
-                data.addRows(result);
-                formatter.format(data, 1);
-                chart_div.show();
-                chart.draw(data, options);
-            });
+        app.user_id_changed = function (dashboard, chart_div) {
+            var rows = $.map(dashboard.mean_time_weekday, function (value) {
+                    return [[value[0], parseInterval(value[1])]];
+                }),
+                data = new google.visualization.DataTable(),
+                options = { hAxis: {title: 'Weekday'} },
+                formatter = new google.visualization.DateFormat({pattern: 'HH:mm:ss'}),
+                chart = new google.visualization.ColumnChart(chart_div[0]);
+            data.addColumn('string', 'Weekday');
+            data.addColumn('datetime', 'Mean time (h:m:s)');
+            data.addRows(rows);
+            formatter.format(data, 1);
+            chart_div.show();
+            chart.draw(data, options);
         };
     });
 })(jQuery, app);
@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, array-backed storage of presence data.
+"""
+from __future__ import unicode_literals
+
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, time
+from itertools import izip
+from operator import itemgetter
+
+from presence_analyzer.aggregation import (
+    add_entry,
+    weekday_of,
+    weekday_stats,
+    weekday_totals,
+)
+
+# overlay of LayeredStore bigger than this share of base is combined into it
+OVERLAY_MAX_SHARE = 0.25
+# users whose WeekdayRanges and WeekdayDistribution are kept by the store
+USER_CACHE_SIZE = 256
+
+
+def seconds_since_midnight(time):
+    """
+    Calculates amount of seconds since midnight.
+    """
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def seconds_to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class UserPresence(object):
+    """
+    Presence entries of single user, sorted by date.
+
+    Raw ``dates`` (ordinals), ``starts`` and ``ends`` (seconds since midnight)
+    are exposed directly. For convenience it also behaves like read-only
+    mapping: {datetime.date: {'start': datetime.time, 'end': datetime.time}}.
+    """
+    __slots__ = ('dates', 'starts', 'ends')
+
+    def __init__(self, dates, starts, ends):
+        self.dates = dates
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __iter__(self):
+        return (date.fromordinal(day) for day in self.dates)
+
+    def _index(self, day):
+        """
+        Returns position of given date or -1 when it's missing.
+        """
+        ordinal = day.toordinal()
+        i = bisect_left(self.dates, ordinal)
+        if i < len(self.dates) and self.dates[i] == ordinal:
+            return i
+        return -1
+
+    def __contains__(self, day):
+        return self._index(day) >= 0
+
+    def __getitem__(self, day):
+        i = self._index(day)
+        if i < 0:
+            raise KeyError(day)
+        return {
+            'start': seconds_to_time(self.starts[i]),
+            'end': seconds_to_time(self.ends[i]),
+        }
+
+    def keys(self):
+        """
+        Returns list of dates.
+        """
+        return list(self)
+
+    def rows(self):
+        """
+        Iterates over (date ordinal, start, end) triples.
+        """
+        return izip(self.dates, self.starts, self.ends)
+
+
+def _cached(cache, user_id, build):
+    """
+    Returns cache[user_id], built by build(user_id) when missing.
+
+    Full cache is emptied before adding, so it holds at most
+    USER_CACHE_SIZE users.
+    """
+    value = cache.get(user_id)
+    if value is None:
+        value = build(user_id)
+        if len(cache) >= USER_CACHE_SIZE:
+            cache.clear()
+        cache[user_id] = value
+    return value
+
+
+def _prefix(values, low, position):
+    """
+    Returns sum of run items before position from cumulative values.
+    """
+    return values[position - 1] if position > low else 0
+
+
+class WeekdayRanges(object):
+    """
+    Entries of single user grouped by weekday with cumulative sums.
+
+    Within every weekday run dates are sorted, so stats of any date range
+    take two bisects and a few subtractions per weekday.
+    """
+    def __init__(self, user):
+        runs = [[] for _ in range(7)]
+        for row in user.rows():
+            runs[weekday_of(row[0])].append(row)
+        self.bounds = [0]
+        self.dates = array(b'i')
+        self.intervals, self.starts, self.ends = (
+            array(b'l'), array(b'l'), array(b'l'))
+        for run in runs:
+            interval_sum = start_sum = end_sum = 0
+            for day, start, end in run:
+                interval_sum += end - start
+                start_sum += start
+                end_sum += end
+                self.dates.append(day)
+                self.intervals.append(interval_sum)
+                self.starts.append(start_sum)
+                self.ends.append(end_sum)
+            self.bounds.append(len(self.dates))
+
+    def stats(self, first=None, last=None):
+        """
+        Returns weekday stats of entries from first to last date ordinal,
+        both inclusive; None means unbounded.
+        """
+        result = []
+        for weekday in range(7):
+            low, high = self.bounds[weekday], self.bounds[weekday + 1]
+            i = low if first is None \
+                else bisect_left(self.dates, first, low, high)
+            j = high if last is None \
+                else bisect_right(self.dates, last, low, high)
+            if j <= i:
+                result.append((0, 0, 0, 0))
+                continue
+            result.append((
+                j - i,
+                _prefix(self.intervals, low, j) -
+                _prefix(self.intervals, low, i),
+                _prefix(self.starts, low, j) - _prefix(self.starts, low, i),
+                _prefix(self.ends, low, j) - _prefix(self.ends, low, i),
+            ))
+        return result
+
+
+def percentile(values, q):
+    """
+    Returns q-th percentile (0-100) of sorted values, interpolating
+    linearly between closest ranks. None for no values.
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class WeekdayDistribution(object):
+    """
+    Sorted start times, end times and intervals of user by weekday.
+
+    Answers percentile and histogram queries without sorting again.
+    """
+    KINDS = ('start', 'end', 'interval')
+
+    def __init__(self, rows):
+        grouped = dict((kind, [[] for _ in range(7)]) for kind in self.KINDS)
+        for day, start, end in rows:
+            weekday = weekday_of(day)
+            grouped['start'][weekday].append(start)
+            grouped['end'][weekday].append(end)
+            grouped['interval'][weekday].append(end - start)
+        self.values = dict(
+            (kind, [array(b'i', sorted(items)) for items in lists])
+            for kind, lists in grouped.iteritems()
+        )
+
+    def percentile(self, kind, weekday, q):
+        """
+        Returns q-th percentile of kind values of given weekday or None.
+        """
+        return percentile(self.values[kind][weekday], q)
+
+    def histogram(self, kind, weekday, edges):
+        """
+        Returns counts of kind values of given weekday falling between
+        consecutive edges (lower inclusive, upper exclusive).
+        """
+        values = self.values[kind][weekday]
+        positions = [bisect_left(values, edge) for edge in edges]
+        return [high - low for low, high in izip(positions, positions[1:])]
+
+
+class PresenceStore(object):
+    """
+    Presence entries of all users kept in parallel typed arrays.
+
+    Entries are sorted by user_id and date; entries of given user occupy
+    range bounds[i]:bounds[i + 1] where i is position of user in user_ids.
+
+    weekday_index keeps weekday_stats of every user, it's built together
+    with the store by aggregation.weekday_totals. Already known stats of
+    unchanged users can be passed in.
+
+    version and last_modified describe source file, loader fills them in.
+    shared is set for stores mapped from snapshot, whose pages are shared by
+    worker processes; merge() keeps their arrays instead of copying them.
+    """
+    has_entries = True
+    shared = False
+
+    def __init__(self, user_ids, bounds, dates, starts, ends,
+                 weekday_index=None):
+        self.user_ids = user_ids
+        self.bounds = bounds
+        self.dates = dates
+        self.starts = starts
+        self.ends = ends
+        self.version = None
+        self.last_modified = None
+        self._ranges = {}
+        self._distributions = {}
+        self._offsets = dict(
+            (user_id, (bounds[i], bounds[i + 1]))
+            for i, user_id in enumerate(user_ids)
+        )
+        self.weekday_index = dict(weekday_index or {})
+        missing = set(user_ids).difference(self.weekday_index)
+        if missing:
+            self.weekday_index.update(weekday_totals(
+                user_ids, bounds, dates, starts, ends, missing))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from iterable of (user_id, date ordinal, start, end).
+
+        When user has more than one entry for given date the last one wins.
+        """
+        rows = sorted(rows, key=itemgetter(0, 1))
+        user_ids, bounds = array(b'l'), array(b'l')
+        dates, starts, ends = array(b'i'), array(b'i'), array(b'i')
+        last = None
+        for user_id, day, start, end in rows:
+            if last == (user_id, day):
+                starts[-1], ends[-1] = start, end
+                continue
+            if last is None or last[0] != user_id:
+                user_ids.append(user_id)
+                bounds.append(len(dates))
+            last = (user_id, day)
+            dates.append(day)
+            starts.append(start)
+            ends.append(end)
+        bounds.append(len(dates))
+        return cls(user_ids, bounds, dates, starts, ends)
+
+    @classmethod
+    def combine(cls, stores):
+        """
+        Combines stores into one, entries of later stores win for the same
+        user and date.
+
+        Users present in one store only are copied slice by slice together
+        with their weekday stats.
+        """
+        user_ids, bounds = array(b'l'), array(b'l')
+        dates, starts, ends = array(b'i'), array(b'i'), array(b'i')
+        weekday_index = {}
+        all_user_ids = set()
+        for store in stores:
+            all_user_ids.update(store.user_ids)
+        for user_id in sorted(all_user_ids):
+            sources = [store for store in stores if user_id in store]
+            user_ids.append(user_id)
+            bounds.append(len(dates))
+            if len(sources) == 1:
+                source = sources[0][user_id]
+                dates.extend(source.dates)
+                starts.extend(source.starts)
+                ends.extend(source.ends)
+                weekday_index[user_id] = sources[0].weekday_index[user_id]
+                continue
+            entries = {}
+            for store in sources:
+                entries.update(
+                    (day, (start, end))
+                    for day, start, end in store[user_id].rows()
+                )
+            for day in sorted(entries):
+                dates.append(day)
+                starts.append(entries[day][0])
+                ends.append(entries[day][1])
+        bounds.append(len(dates))
+        return cls(user_ids, bounds, dates, starts, ends, weekday_index)
+
+    def merge(self, rows):
+        """
+        Returns new store with given rows added.
+
+        Rows win over existing entries of the same user and date. Arrays of
+        shared store are kept as they are, see LayeredStore.
+        """
+        new = PresenceStore.from_rows(rows)
+        if not new.user_ids:
+            return self
+        if self.shared:
+            return layer(self, new)
+        return PresenceStore.combine([self, new])
+
+    def flatten(self):
+        """
+        Returns store with all entries in its own arrays, i.e. itself.
+        """
+        return self
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns weekday stats of user limited to dates from first to last
+        ordinal (inclusive) when given.
+
+        WeekdayRanges of user are built on first range query and kept for
+        up to USER_CACHE_SIZE users.
+        """
+        if first is None and last is None:
+            return self.weekday_index[user_id]
+        ranges = _cached(self._ranges, user_id,
+                         lambda key: WeekdayRanges(self[key]))
+        return ranges.stats(first, last)
+
+    def weekday_distribution(self, user_id, first=None, last=None):
+        """
+        Returns WeekdayDistribution of user, limited to dates from first to
+        last ordinal (inclusive) when given.
+
+        Distribution of all entries is built on first query and kept for
+        up to USER_CACHE_SIZE users.
+        """
+        if first is not None or last is not None:
+            return WeekdayDistribution(
+                _user_slice(self[user_id], first, last))
+        return _cached(self._distributions, user_id,
+                       lambda key: WeekdayDistribution(self[key].rows()))
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __iter__(self):
+        return iter(self.user_ids)
+
+    def __contains__(self, user_id):
+        return user_id in self._offsets
+
+    def __getitem__(self, user_id):
+        begin, end = self._offsets[user_id]
+        return UserPresence(
+            self.dates[begin:end],
+            self.starts[begin:end],
+            self.ends[begin:end],
+        )
+
+    def keys(self):
+        """
+        Returns list of user ids.
+        """
+        return list(self.user_ids)
+
+
+def _user_slice(user, first, last):
+    """
+    Returns (date ordinal, start, end) rows of user from first to last
+    ordinal (inclusive), None means unbounded.
+    """
+    i = 0 if first is None else bisect_left(user.dates, first)
+    j = len(user) if last is None else bisect_right(user.dates, last)
+    return izip(user.dates[i:j], user.starts[i:j], user.ends[i:j])
+
+
+def layer(base, overlay):
+    """
+    Returns store of base entries overridden by overlay entries.
+
+    Overlay is kept on top of base (LayeredStore) while it stays smaller
+    than OVERLAY_MAX_SHARE of base, then both are combined into one private
+    store; snapshot should be rebuilt well before that.
+    """
+    if len(overlay.dates) > len(base.dates) * OVERLAY_MAX_SHARE:
+        return PresenceStore.combine([base, overlay])
+    return LayeredStore(base, overlay)
+
+
+class LayeredStore(object):
+    """
+    PresenceStore (e.g. mapped from snapshot) with appended entries kept in
+    separate, small overlay store.
+
+    Arrays of base are never copied, so pages of mapped snapshot stay
+    shared between worker processes while rows are appended to the file.
+    Entries of users present in overlay are combined on access; their
+    weekday stats are adjusted once, when overlay is built.
+    """
+    has_entries = True
+
+    def __init__(self, base, overlay):
+        self.base = base
+        self.overlay = overlay
+        self.version = None
+        self.last_modified = None
+        self.weekday_index = dict(base.weekday_index)
+        for user_id in overlay:
+            self.weekday_index[user_id] = self._combined_stats(user_id)
+
+    def _combined_stats(self, user_id):
+        """
+        Returns weekday stats of user with overlay entries replacing base
+        entries of the same date.
+        """
+        stats = [list(item) for item in self.overlay.weekday_index[user_id]]
+        if user_id not in self.base:
+            return [tuple(item) for item in stats]
+        for curr, item in izip(stats, self.base.weekday_index[user_id]):
+            for i, value in enumerate(item):
+                curr[i] += value
+        # pylint: disable=protected-access
+        begin, end = self.base._offsets[user_id]
+        dates = self.base.dates
+        for day in self.overlay[user_id].dates:
+            i = bisect_left(dates, day, begin, end)
+            if i < end and dates[i] == day:
+                add_entry(stats, day, self.base.starts[i], self.base.ends[i],
+                          count=-1)
+        return [tuple(item) for item in stats]
+
+    def merge(self, rows):
+        """
+        Returns new store with given rows added to overlay.
+        """
+        new = PresenceStore.from_rows(rows)
+        if not new.user_ids:
+            return self
+        return layer(self.base, PresenceStore.combine([self.overlay, new]))
+
+    def flatten(self):
+        """
+        Returns PresenceStore with base and overlay entries combined.
+        """
+        store = PresenceStore.combine([self.base, self.overlay])
+        store.version, store.last_modified = self.version, self.last_modified
+        return store
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns weekday stats of user limited to dates from first to last
+        ordinal (inclusive) when given.
+        """
+        if first is None and last is None:
+            return self.weekday_index[user_id]
+        if user_id not in self.overlay:
+            return self.base.weekday_stats(user_id, first, last)
+        return weekday_stats(_user_slice(self[user_id], first, last))
+
+    def weekday_distribution(self, user_id, first=None, last=None):
+        """
+        Returns WeekdayDistribution of user, limited to dates from first to
+        last ordinal (inclusive) when given.
+        """
+        if user_id not in self.overlay:
+            return self.base.weekday_distribution(user_id, first, last)
+        return WeekdayDistribution(
+            _user_slice(self[user_id], first, last))
+
+    def __len__(self):
+        return len(self.weekday_index)
+
+    def __iter__(self):
+        return iter(sorted(self.weekday_index))
+
+    def __contains__(self, user_id):
+        return user_id in self.weekday_index
+
+    def __getitem__(self, user_id):
+        if user_id not in self.overlay:
+            return self.base[user_id]
+        entries = {}
+        if user_id in self.base:
+            entries.update(
+                (day, (start, end))
+                for day, start, end in self.base[user_id].rows()
+            )
+        entries.update(
+            (day, (start, end))
+            for day, start, end in self.overlay[user_id].rows()
+        )
+        dates = sorted(entries)
+        return UserPresence(
+            array(b'i', dates),
+            array(b'i', [entries[day][0] for day in dates]),
+            array(b'i', [entries[day][1] for day in dates]),
+        )
+
+    def keys(self):
+        """
+        Returns list of user ids.
+        """
+        return list(self)
+
+
+class PresenceSummary(object):
+    """
+    Weekday stats of all users without per-day entries.
+
+    Offers the same weekday_index, version and last_modified as
+    PresenceStore, its memory use depends only on number of users.
+    """
+    has_entries = False
+
+    def __init__(self, weekday_index):
+        self.weekday_index = weekday_index
+        self.version = None
+        self.last_modified = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Folds (user_id, date ordinal, start, end) rows into weekday stats.
+
+        Like in PresenceStore the last entry of user and date wins. Entries
+        are kept only for the run of consecutive rows of one user, so
+        memory use stays O(users) for files grouped by user (as exported);
+        duplicates split by rows of other users are all counted.
+        """
+        accumulators = {}
+        current, entries = None, {}
+        for user_id, day, start, end in rows:
+            if user_id != current:
+                cls._fold(accumulators, current, entries)
+                current, entries = user_id, {}
+            entries[day] = (start, end)
+        cls._fold(accumulators, current, entries)
+        return cls(dict(
+            (user_id, [tuple(item) for item in stats])
+            for user_id, stats in accumulators.iteritems()
+        ))
+
+    @staticmethod
+    def _fold(accumulators, user_id, entries):
+        """
+        Adds entries (date ordinal -> (start, end)) of user to weekday
+        stats being built.
+        """
+        if not entries:
+            return
+        stats = accumulators.get(user_id)
+        if stats is None:
+            stats = accumulators[user_id] = [[0, 0, 0, 0] for _ in range(7)]
+        for day, (start, end) in entries.iteritems():
+            add_entry(stats, day, start, end)
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns weekday stats of user. Date ranges need per-day entries,
+        so they raise ValueError here.
+        """
+        if first is not None or last is not None:
+            raise ValueError('Date ranges are not supported in summary')
+        return self.weekday_index[user_id]
+
+    def weekday_distribution(self, user_id, first=None, last=None):
+        """
+        Distributions need per-day entries, raises ValueError.
+        """
+        raise ValueError('Distributions are not supported in summary')
+
+    def __len__(self):
+        return len(self.weekday_index)
+
+    def __iter__(self):
+        return iter(sorted(self.weekday_index))
+
+    def __contains__(self, user_id):
+        return user_id in self.weekday_index
+
+    def keys(self):
+        """
+        Returns list of user ids.
+        """
+        return list(self)
@@ -4,14 +4,105 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
+import os
 import os.path
 import json
+import logging
+import shutil
+import signal
+import tempfile
 import datetime
 import time
 import unittest
+import urllib2
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from functools import partial
+from threading import Event, Thread
 
-from presence_analyzer import main, views, utils
+from presence_analyzer import (
+    main, views, utils, store, loader, snapshot, users, backends, metrics,
+    profiling, serialization, prefork, watcher, aggregation, avatars
+)
+
+
+class ThreadExecutor(object):
+    """
+    Executor running every function in new thread, like gevent ThreadPool.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def apply(self, function, args=(), kwargs=None):
+        """
+        Runs function in new thread and returns its result.
+        """
+        result = {}
+
+        def target():
+            """
+            Keeps result or raised exception.
+            """
+            try:
+                result['value'] = function(*args, **(kwargs or {}))
+            except Exception as exc:  # pylint: disable=broad-except
+                result['error'] = exc
+
+        self.calls.append(function)
+        thread = Thread(target=target)
+        thread.start()
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def spawn(self, function):
+        """
+        Runs function in new thread.
+        """
+        self.calls.append(function)
+        thread = Thread(target=function)
+        thread.start()
+        return thread
+
+
+class AvatarHandler(BaseHTTPRequestHandler):
+    """
+    Stub of avatar upstream, serves fake image of any path.
+    """
+    image = b'\x89PNG fake image'
+    etag = '"upstream-1"'
+    paths = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serves image or 304 when client has it already.
+        """
+        self.paths.append(self.path)
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.image)))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(self.image)
+
+    def log_message(self, *args):
+        """
+        Keeps test output clean.
+        """
+
+
+class KeepAliveAvatarHandler(AvatarHandler):
+    """
+    Stub of avatar upstream closing idle keep-alive connections quickly.
+    """
+    protocol_version = str('HTTP/1.1')
+    timeout = 0.1
 
 
 class PresenceAnalyzerTestCase(unittest.TestCase):
@@ -83,6 +174,23 @@ class PresenceAnalyzerViewsTestCase(PresenceAnalyzerTestCase):
             }
         )
 
+    def test_api_users_sorted_paged(self):
+        """
+        Test sorting and paging of users listing.
+        """
+        data = self.endpoint_return_json_data('/api/v1/users?sort=name')
+        self.assertEqual([user['name'] for user in data],
+                         ['Adam P.', 'Maciej D.', 'Maciej Z.'])
+        data = self.endpoint_return_json_data(
+            '/api/v1/users?sort=-user_id&page=2&per_page=2')
+        self.assertEqual([user['user_id'] for user in data], [10])
+        data = self.endpoint_return_json_data(
+            '/api/v1/users?page=3&per_page=2')
+        self.assertEqual(data, [])
+        for query in ('sort=avatar', 'page=0&per_page=2', 'per_page=-1'):
+            resp = self.client.get('/api/v1/users?' + query)
+            self.assertEqual(resp.status_code, 400)
+
     def test_api_start_end(self):
         """
         Test mean start and end presence of user per day.
@@ -143,6 +251,534 @@ class PresenceAnalyzerViewsTestCase(PresenceAnalyzerTestCase):
         )
         self.endpoint_should_return_404('/api/v1/presence_weekday/1')
 
+    def test_api_conditional_requests(self):
+        """
+        Test ETag and Last-Modified revalidation of API responses.
+        """
+        for url in ('/api/v1/users', '/api/v1/presence_weekday/11'):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+            last_modified = resp.headers['Last-Modified']
+            self.assertTrue(etag.startswith('"'))
+            self.assertEqual(self.client.get(url).headers['ETag'], etag)
+
+            resp = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b'')
+            resp = self.client.get(
+                url, headers={'If-Modified-Since': last_modified})
+            self.assertEqual(resp.status_code, 304)
+            resp = self.client.get(url, headers={'If-None-Match': '"x"'})
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertNotEqual(
+            self.client.get('/api/v1/presence_weekday/10').headers['ETag'],
+            self.client.get('/api/v1/presence_weekday/11').headers['ETag']
+        )
+        self.endpoint_should_return_404('/api/v1/presence_weekday/1')
+
+    def test_api_date_range(self):
+        """
+        Test limiting statistics to date range.
+        """
+        data = self.endpoint_return_json_data(
+            '/api/v1/presence_weekday/11?from=2013-09-06&to=2013-09-11')
+        self.assertEqual(
+            data,
+            [
+                ['Weekday', 'Presence (s)'],
+                ['Mon', 24123],
+                ['Tue', 16564],
+                ['Wed', 25321],
+                ['Thu', 0],
+                ['Fri', 0],
+                ['Sat', 0],
+                ['Sun', 0],
+            ]
+        )
+        data = self.endpoint_return_json_data(
+            '/api/v1/mean_time_weekday/11?from=2013-09-06')
+        self.assertEqual(data[3], ['Thu', 22969.0])
+        data = self.endpoint_return_json_data(
+            '/api/v1/presence_start_end_per_weekday/11?to=2013-09-06')
+        self.assertEqual(data[3], ['Thu', '09:28:08', '15:51:27'])
+        data = self.endpoint_return_json_data(
+            '/api/v1/bulk/presence_weekday?user_ids=all&from=2014-01-01')
+        self.assertEqual(data['10'][1:], [[day, 0] for day in (
+            'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')])
+        resp = self.client.get('/api/v1/presence_weekday/11?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_sqlite_backend(self):
+        """
+        Test views give the same results with SQLite backend.
+        """
+        urls = [
+            '/api/v1/mean_time_weekday/11',
+            '/api/v1/presence_weekday/10',
+            '/api/v1/presence_start_end_per_weekday/11?from=2013-09-06',
+            '/api/v1/bulk/presence_weekday?user_ids=all',
+            '/api/v1/percentiles_weekday/11?q=10,50,75&to=2013-09-11',
+            '/api/v1/arrival_histogram/10?bin=3600',
+        ]
+        expected = [self.endpoint_return_json_data(url) for url in urls]
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        db_path = os.path.join(tmp_dir, 'presence.sqlite')
+        backends.import_csv(db_path, main.app.config['DATA_CSV'])
+        main.app.config.update({
+            'STORAGE_BACKEND': 'sqlite',
+            'SQLITE_DB': db_path,
+        })
+        self.addCleanup(main.app.config.update, {'STORAGE_BACKEND': 'csv'})
+
+        self.assertEqual(
+            [self.endpoint_return_json_data(url) for url in urls],
+            expected
+        )
+        self.endpoint_should_return_404('/api/v1/presence_weekday/1')
+
+    def test_api_metrics(self):
+        """
+        Test metrics endpoint and Server-Timing header.
+        """
+        main.app.config['SERVER_TIMING'] = True
+        self.addCleanup(main.app.config.update, {'SERVER_TIMING': False})
+        resp = self.client.get('/api/v1/mean_time_weekday/10?from=2013-09-01')
+        self.assertIn('aggregation;dur=', resp.headers['Server-Timing'])
+        self.assertIn('serialization;dur=', resp.headers['Server-Timing'])
+
+        resp = self.client.get('/api/v1/_metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        text = resp.data.decode('utf-8')
+        self.assertIn('# TYPE presence_analyzer_rows_parsed_total counter',
+                      text)
+        self.assertIn('presence_analyzer_cache_requests_total'
+                      '{function="get_data",result="hit"}', text)
+        self.assertIn('presence_analyzer_request_seconds_count'
+                      '{endpoint="mean_time_weekday_view"}', text)
+        self.assertIn('presence_analyzer_aggregation_seconds_sum', text)
+
+        main.app.config['SERVER_TIMING'] = False
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertNotIn('Server-Timing', resp.headers)
+
+    def test_api_profiling(self):
+        """
+        Test profiling of requests asking for it.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        main.app.config.update({
+            'PROFILING_ENABLED': True,
+            'PROFILES_DIR': os.path.join(tmp_dir, 'profiles'),
+        })
+        self.addCleanup(main.app.config.update, {'PROFILING_ENABLED': False})
+
+        resp = self.client.get('/api/v1/presence_weekday/11')
+        self.assertNotIn('X-Profile-Id', resp.headers)
+        resp = self.client.get('/api/v1/presence_weekday/11',
+                               headers={'X-Profile': '1'})
+        self.assertEqual(resp.status_code, 200)
+        name = resp.headers['X-Profile-Id']
+        self.assertIn('presence_weekday_view', name)
+        resp = self.client.get('/api/v1/users?_profile=1')
+        self.assertIn('users_view', resp.headers['X-Profile-Id'])
+
+        profiles = profiling.list_profiles(main.app.config['PROFILES_DIR'])
+        self.assertEqual(len(profiles), 2)
+        self.assertIn(name, [profile[0] for profile in profiles])
+        with open(os.path.join(tmp_dir, 'profiles', name + '.txt')) as txt:
+            self.assertIn('function calls', txt.read())
+
+        main.app.config['PROFILING_ENABLED'] = False
+        resp = self.client.get('/api/v1/users?_profile=1')
+        self.assertNotIn('X-Profile-Id', resp.headers)
+
+    def test_api_bulk_stats(self):
+        """
+        Test statistics of many users in one request.
+        """
+        data = self.endpoint_return_json_data(
+            '/api/v1/bulk/mean_time_weekday?user_ids=11,1')
+        self.assertEqual(
+            data,
+            {
+                '11': self.endpoint_return_json_data(
+                    '/api/v1/mean_time_weekday/11'),
+                '1': None,
+            }
+        )
+        data = self.endpoint_return_json_data(
+            '/api/v1/bulk/presence_weekday?user_ids=all')
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+        self.assertEqual(
+            data['10'],
+            self.endpoint_return_json_data('/api/v1/presence_weekday/10')
+        )
+        data = self.endpoint_return_json_data(
+            '/api/v1/bulk/presence_start_end_per_weekday?user_ids=10')
+        self.assertEqual(
+            data['10'],
+            self.endpoint_return_json_data(
+                '/api/v1/presence_start_end_per_weekday/10')
+        )
+        self.endpoint_should_return_404('/api/v1/bulk/users?user_ids=all')
+        resp = self.client.get('/api/v1/bulk/presence_weekday?user_ids=x')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_dashboard(self):
+        """
+        Test combined dashboard of user.
+        """
+        data = self.endpoint_return_json_data('/api/v1/dashboard/10')
+        self.assertEqual(data['user_id'], 10)
+        self.assertEqual(data['name'], 'Maciej Z.')
+        self.assertEqual(
+            data['avatar_url'],
+            'https://intranet.stxnext.pl:443/api/images/users/10'
+        )
+        for key, url in (
+                ('mean_time_weekday', '/api/v1/mean_time_weekday/10'),
+                ('presence_weekday', '/api/v1/presence_weekday/10'),
+                ('presence_start_end',
+                 '/api/v1/presence_start_end_per_weekday/10')):
+            self.assertEqual(data[key], self.endpoint_return_json_data(url))
+
+        data = self.endpoint_return_json_data(
+            '/api/v1/dashboard/11?from=2013-09-10')
+        self.assertEqual(
+            data['mean_time_weekday'],
+            self.endpoint_return_json_data(
+                '/api/v1/mean_time_weekday/11?from=2013-09-10')
+        )
+        self.endpoint_should_return_404('/api/v1/dashboard/141')
+        resp = self.client.get('/api/v1/mean_time_weekday/11?from=10')
+        self.assertEqual(resp.status_code, 400)
+
+        for page in ('/', '/mean_time_weekday',
+                     '/presence_start_end'):
+            self.assertIn(b'data-api-url="/api/v1/dashboard/"',
+                          self.client.get(page).data)
+
+    def test_api_avatars(self):
+        """
+        Test avatars proxied from upstream and cached on disk.
+        """
+        server = HTTPServer(('127.0.0.1', 0), AvatarHandler)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        AvatarHandler.paths = []
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        for key in ('AVATAR_UPSTREAM', 'AVATAR_CACHE_DIR',
+                    'AVATAR_REVALIDATE'):
+            self.addCleanup(main.app.config.pop, key, None)
+        main.app.config.update({
+            'AVATAR_UPSTREAM': 'http://127.0.0.1:{0}'.format(
+                server.server_address[1]),
+            'AVATAR_CACHE_DIR': os.path.join(tmp_dir, 'cached'),
+        })
+
+        executor = ThreadExecutor()
+        main.app.extensions['executor'] = executor
+        self.addCleanup(main.app.extensions.pop, 'executor')
+
+        resp = self.client.get('/api/v1/avatars/10')
+        self.assertEqual(len(executor.calls), 1)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/png')
+        self.assertEqual(resp.data, AvatarHandler.image)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertTrue(resp.cache_control.public)
+        self.assertEqual(resp.cache_control.max_age, 86400)
+        etag = resp.headers['ETag']
+        self.assertEqual(AvatarHandler.paths, ['/api/images/users/10'])
+
+        resp = self.client.get('/api/v1/avatars/10')
+        self.assertEqual(resp.data, AvatarHandler.image)
+        self.assertEqual(len(AvatarHandler.paths), 1)
+        resp = self.client.get('/api/v1/avatars/10',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.endpoint_should_return_404('/api/v1/avatars/12')
+        self.assertEqual(len(AvatarHandler.paths), 1)
+
+        # due for revalidation, upstream answers 304
+        main.app.config.update({
+            'AVATAR_CACHE_DIR': os.path.join(tmp_dir, 'revalidated'),
+            'AVATAR_REVALIDATE': 0,
+        })
+        self.client.get('/api/v1/avatars/11')
+        resp = self.client.get('/api/v1/avatars/11')
+        self.assertEqual(resp.data, AvatarHandler.image)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(len(AvatarHandler.paths), 3)
+
+        # upstream down: stale avatar is served, missing one fails
+        server.shutdown()
+        server.server_close()
+        resp = self.client.get('/api/v1/avatars/11')
+        self.assertEqual(resp.data, AvatarHandler.image)
+        resp = self.client.get('/api/v1/avatars/141')
+        self.assertEqual(resp.status_code, 502)
+
+        self.assertIn(b'data-api-url="/api/v1/avatars/"',
+                      self.client.get('/').data)
+
+    def test_api_percentiles_weekday(self):
+        """
+        Test percentiles of presence by weekday.
+        """
+        data = self.endpoint_return_json_data(
+            '/api/v1/percentiles_weekday/11')
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[3], [
+            'Thu',
+            {
+                'start': {'50': '09:53:22', '90': '10:13:33'},
+                'end': {'50': '16:16:26', '90': '16:36:25'},
+                'interval': {'50': 22984.0, '90': 22996.0},
+            }
+        ])
+        self.assertEqual(data[5][1]['start'], {'50': None, '90': None})
+
+        data = self.endpoint_return_json_data(
+            '/api/v1/percentiles_weekday/11?q=0,100&to=2013-09-05')
+        self.assertEqual(data[3][1]['start'], {'0': '09:28:08',
+                                               '100': '09:28:08'})
+        self.assertEqual(data[0][1]['start'], {'0': None, '100': None})
+        for url in ('/api/v1/percentiles_weekday/11?q=101',
+                    '/api/v1/percentiles_weekday/11?q=a',
+                    '/api/v1/percentiles_weekday/11?from=x'):
+            self.assertEqual(self.client.get(url).status_code, 400)
+        self.endpoint_should_return_404('/api/v1/percentiles_weekday/1')
+
+    def test_api_arrival_histogram(self):
+        """
+        Test histogram of arrival times by weekday.
+        """
+        data = self.endpoint_return_json_data(
+            '/api/v1/arrival_histogram/11?bin=21600')
+        self.assertEqual(data['bins'],
+                         ['00:00:00', '06:00:00', '12:00:00', '18:00:00'])
+        self.assertEqual(data['weekdays'][3], ['Thu', [0, 2, 0, 0]])
+        self.assertEqual(data['weekdays'][4], ['Fri', [0, 0, 1, 0]])
+
+        data = self.endpoint_return_json_data('/api/v1/arrival_histogram/10')
+        self.assertEqual(len(data['bins']), 48)
+        self.assertEqual(sum(sum(counts) for _, counts in data['weekdays']),
+                         3)
+        self.assertEqual(
+            self.client.get('/api/v1/arrival_histogram/10?bin=1').status_code,
+            400
+        )
+        self.endpoint_should_return_404('/api/v1/arrival_histogram/1')
+
+        self.addCleanup(utils.get_data.reload)
+        self.addCleanup(main.app.config.update, {'DATA_STREAMING': False})
+        main.app.config['DATA_STREAMING'] = True
+        utils.get_data.reload()
+        self.assertEqual(
+            self.client.get('/api/v1/arrival_histogram/11').status_code, 400)
+
+    def test_api_rollup(self):
+        """
+        Test statistics of user groups.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        users_xml = os.path.join(tmp_dir, 'users.xml')
+        with open(main.app.config['USERS_XML']) as source:
+            content = source.read()
+        with open(users_xml, 'w') as target:
+            target.write(content.replace(
+                '<name>Maciej D.</name>',
+                '<name>Maciej D.</name><group>backend</group>'
+                '<group> qa </group>'
+            ))
+        groups_file = os.path.join(tmp_dir, 'groups.json')
+        with open(groups_file, 'w') as target:
+            json.dump({'qa': [10, '141'], 'broken': ['x']}, target)
+        self.addCleanup(main.app.config.update, {
+            'USERS_XML': main.app.config['USERS_XML'],
+            'GROUPS_FILE': None,
+        })
+        main.app.config.update({
+            'USERS_XML': users_xml,
+            'GROUPS_FILE': groups_file,
+        })
+
+        self.assertEqual(self.endpoint_return_json_data('/api/v1/groups'),
+                         {'backend': [11], 'qa': [10, 11, 141]})
+        self.assertEqual(
+            self.endpoint_return_json_data(
+                '/api/v1/rollup/mean_time_weekday/backend'),
+            self.endpoint_return_json_data('/api/v1/mean_time_weekday/11')
+        )
+        data = self.endpoint_return_json_data(
+            '/api/v1/rollup/presence_weekday/qa')
+        self.assertEqual(data[0], ['Weekday', 'Presence (s)'])
+        self.assertEqual(data[2], ['Tue', 30047 + 16564])
+        self.assertEqual(
+            self.endpoint_return_json_data(
+                '/api/v1/rollup/presence_weekday/all'),
+            data
+        )
+        data = self.endpoint_return_json_data(
+            '/api/v1/rollup/presence_start_end_per_weekday/qa'
+            '?from=2013-09-12&to=2013-09-12')
+        self.assertEqual(data[3], ['Thu', '10:33:41', '17:02:38'])
+
+        self.endpoint_should_return_404('/api/v1/rollup/presence_weekday/x')
+        self.endpoint_should_return_404('/api/v1/rollup/users/qa')
+        self.assertEqual(
+            self.client.get(
+                '/api/v1/rollup/presence_weekday/qa?to=x').status_code,
+            400
+        )
+
+    def test_api_executor(self):
+        """
+        Test computing responses in registered executor.
+        """
+        executor = ThreadExecutor()
+        main.app.extensions['executor'] = executor
+        self.addCleanup(main.app.extensions.pop, 'executor')
+
+        url = '/api/v1/presence_weekday/11?from=2013-09-02'
+        data = self.endpoint_return_json_data(url)
+        self.assertEqual(len(executor.calls), 1)
+        self.assertEqual(data[0], ['Weekday', 'Presence (s)'])
+        self.assertEqual(self.endpoint_return_json_data(url), data)
+        self.assertEqual(len(executor.calls), 1)
+        self.endpoint_should_return_404('/api/v1/presence_weekday/2')
+        self.assertEqual(len(executor.calls), 2)
+
+        # bulk statistics, streamed ones in batches
+        resp = self.client.get('/api/v1/bulk/presence_weekday?user_ids=all')
+        self.assertItemsEqual(json.loads(resp.data).keys(), ['10', '11'])
+        self.assertEqual(len(executor.calls), 3)
+        resp = self.client.get('/api/v1/bulk/presence_weekday?user_ids=all'
+                               '&from=2013-09-01')
+        self.assertItemsEqual(json.loads(resp.data).keys(), ['10', '11'])
+        self.assertEqual(len(executor.calls), 5)
+        resp = self.client.get('/api/v1/bulk/presence_weekday?user_ids=10,1')
+        self.assertIsNone(json.loads(resp.data)['1'])
+        self.assertEqual(len(executor.calls), 6)
+
+    def test_prefork_server(self):
+        """
+        Test workers of pre-fork server are replaced when data changes.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(main.app.config['DATA_CSV'], path)
+        self.addCleanup(main.app.config.update,
+                        {'DATA_CSV': main.app.config['DATA_CSV']})
+        main.app.config['DATA_CSV'] = path
+        werkzeug_log = logging.getLogger('werkzeug')
+        self.addCleanup(werkzeug_log.setLevel, werkzeug_log.level)
+        werkzeug_log.setLevel(logging.ERROR)
+
+        sock = prefork.listen('127.0.0.1', 0)
+        self.addCleanup(sock.close)
+        master = prefork.Master(main.app, sock, workers=2,
+                                check_interval=0.1)
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                master.run()
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+        self.addCleanup(os.waitpid, pid, 0)
+        self.addCleanup(os.kill, pid, signal.SIGTERM)
+
+        url = 'http://127.0.0.1:{0}/api/v1/mean_time_weekday/'.format(
+            sock.getsockname()[1])
+        self.assertEqual(
+            json.loads(urllib2.urlopen(url + '10').read()),
+            self.endpoint_return_json_data('/api/v1/mean_time_weekday/10')
+        )
+        with self.assertRaises(urllib2.HTTPError):
+            urllib2.urlopen(url + '12')
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        deadline = time.time() + 10
+        while True:
+            try:
+                data = json.loads(urllib2.urlopen(url + '12').read())
+                break
+            except urllib2.HTTPError:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.1)
+        self.assertEqual(data[1], ['Tue', 28800.0])
+
+    def test_api_compression(self):
+        """
+        Test compression of large responses negotiated via Accept-Encoding.
+        """
+        main.app.config['COMPRESS_MIN_SIZE'] = 100
+        self.addCleanup(main.app.config.update, {'COMPRESS_MIN_SIZE': 1024})
+        url = '/api/v1/presence_start_end_per_weekday/10'
+        plain = self.client.get(url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+
+        for encoding, wbits in serialization.ENCODINGS:
+            resp = self.client.get(url, headers={'Accept-Encoding': encoding})
+            self.assertEqual(resp.headers['Content-Encoding'], encoding)
+            self.assertEqual(zlib.decompress(resp.data, wbits), plain.data)
+            self.assertEqual(resp.headers['ETag'],
+                             plain.headers['ETag'][:-1] + '-' + encoding + '"')
+            resp = self.client.get(url, headers={
+                'Accept-Encoding': encoding,
+                'If-None-Match': resp.headers['ETag'],
+            })
+            self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+        main.app.config['COMPRESS_MIN_SIZE'] = 10 ** 6
+        resp = self.client.get('/api/v1/users',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(len(json.loads(resp.data)), 3)
+
+        resp = self.client.get('/api/v1/bulk/presence_weekday?user_ids=all'
+                               '&from=2013-09-01',
+                               headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+        self.assertNotIn('Content-Length', resp.headers)
+        data = json.loads(zlib.decompress(resp.data))
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+
+        # files are sent as they are
+        resp = self.client.get('/static/js/jquery.min.js',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(len(resp.get_data()),
+                         int(resp.headers['Content-Length']))
+        resp.close()
+
+        main.app.config['COMPRESSION'] = False
+        self.addCleanup(main.app.config.update, {'COMPRESSION': True})
+        resp = self.client.get('/api/v1/bulk/presence_weekday?user_ids=all',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertItemsEqual(json.loads(resp.data).keys(), ['10', '11'])
+
 
 class PresenceAnalyzerUtilsTestCase(PresenceAnalyzerTestCase):
     """
@@ -153,7 +789,7 @@ class PresenceAnalyzerUtilsTestCase(PresenceAnalyzerTestCase):
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, store.PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
@@ -162,6 +798,179 @@ class PresenceAnalyzerUtilsTestCase(PresenceAnalyzerTestCase):
             data[10][sample_date]['start'],
             datetime.time(9, 39, 5)
         )
+        self.assertEqual(list(data[10].starts), [34745, 33592, 38926])
+        self.assertNotIn(1, data)
+
+    def aggregation_engines(self):
+        """
+        Returns use_numpy values of available aggregation engines.
+        """
+        if aggregation.numpy is None:
+            self.assertRaises(ValueError, aggregation.weekday_totals,
+                              [], [0], [], [], [], use_numpy=True)
+            return [False]
+        return [False, True]
+
+    def test_weekday_totals(self):
+        """
+        Test aggregating all users by weekday at once.
+        """
+        rows = [
+            (user_id, 735000 + day, 30000 + user_id * day,
+             60000 + day * 7 % 3000)
+            for user_id in range(1, 6)
+            for day in range(0, 400, user_id)
+        ]
+        data = store.PresenceStore.from_rows(rows)
+        expected = dict(
+            (user_id, store.weekday_stats(data[user_id].rows()))
+            for user_id in data
+        )
+        self.assertEqual(data.weekday_index, expected)
+        for use_numpy in self.aggregation_engines():
+            self.assertEqual(
+                aggregation.weekday_totals(
+                    data.user_ids, data.bounds, data.dates, data.starts,
+                    data.ends, use_numpy=use_numpy),
+                expected
+            )
+            self.assertEqual(
+                aggregation.weekday_totals(
+                    data.user_ids, data.bounds, data.dates, data.starts,
+                    data.ends, only={2}, use_numpy=use_numpy),
+                {2: expected[2]}
+            )
+
+    def test_weekday_series(self):
+        """
+        Test computing results of weekday views of all users at once.
+        """
+        data = utils.get_data()
+        index = dict((user_id, data.weekday_stats(user_id))
+                     for user_id in data)
+        index[1] = [(0, 0, 0, 0)] * 7
+        for use_numpy in self.aggregation_engines():
+            series = aggregation.weekday_series(index, use_numpy)
+            self.assertItemsEqual(series.keys(), [1, 10, 11])
+            for user_id, stats in index.iteritems():
+                # compared encoded, so 0 and 0.0 differ
+                self.assertEqual(
+                    json.dumps(series[user_id], sort_keys=True),
+                    json.dumps({
+                        'mean_time_weekday': utils.mean_time_weekday(stats),
+                        'presence_weekday': utils.presence_weekday(stats),
+                        'presence_start_end': utils.presence_start_end(stats),
+                    }, sort_keys=True)
+                )
+
+    def test_weekday_distribution(self):
+        """
+        Test percentiles and histograms of sorted weekday values.
+        """
+        self.assertIsNone(store.percentile([], 50))
+        self.assertEqual(store.percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(store.percentile([1, 2, 3, 4], 100), 4)
+        self.assertEqual(store.percentile([5], 90), 5)
+
+        # 735000 is a Sunday, 735001 a Monday
+        distribution = store.WeekdayDistribution([
+            (735000, 300, 400),
+            (735007, 100, 500),
+            (735014, 200, 200),
+            (735001, 50, 60),
+        ])
+        self.assertEqual(list(distribution.values['start'][6]),
+                         [100, 200, 300])
+        self.assertEqual(list(distribution.values['interval'][6]),
+                         [0, 100, 400])
+        self.assertEqual(distribution.percentile('end', 6, 50), 400)
+        self.assertEqual(distribution.percentile('start', 0, 50), 50)
+        self.assertIsNone(distribution.percentile('start', 1, 50))
+        self.assertEqual(distribution.histogram('start', 6, [0, 200, 1000]),
+                         [1, 2])
+
+        data = store.PresenceStore.from_rows(
+            (1, day, start, end) for day, start, end in
+            [(735000, 300, 400), (735007, 100, 500), (735014, 200, 200)])
+        self.assertIs(data.weekday_distribution(1),
+                      data.weekday_distribution(1))
+        self.assertEqual(
+            list(data.weekday_distribution(1, 735001, 735014)
+                 .values['start'][6]),
+            [100, 200]
+        )
+
+    def test_presence_store(self):
+        """
+        Test building presence store from rows.
+        """
+        data = store.PresenceStore.from_rows([
+            (2, 735000, 10, 20),
+            (1, 735001, 30, 40),
+            (1, 735000, 50, 60),
+            (1, 735001, 70, 80),
+        ])
+        self.assertEqual(list(data.user_ids), [1, 2])
+        self.assertEqual(list(data.bounds), [0, 2, 3])
+        self.assertEqual(list(data[1].dates), [735000, 735001])
+        self.assertEqual(list(data[1].starts), [50, 70])
+        self.assertEqual(list(data[1].ends), [60, 80])
+        self.assertEqual(list(data[2].rows()), [(735000, 10, 20)])
+        self.assertEqual(
+            list(data[2]),
+            [datetime.date.fromordinal(735000)]
+        )
+        self.assertRaises(KeyError, lambda: data[3])
+
+    def test_serializer(self):
+        """
+        Test choosing JSON serializer and pre-encoded payloads.
+        """
+        self.addCleanup(main.app.config.update, {'JSON_SERIALIZER': 'auto'})
+        with main.app.test_request_context():
+            self.assertIn(serialization.get_serializer(),
+                          serialization.SERIALIZERS.values())
+            main.app.config['JSON_SERIALIZER'] = 'json'
+            self.assertIs(serialization.get_serializer(), json.dumps)
+            main.app.config['JSON_SERIALIZER'] = 'missing'
+            self.assertIs(serialization.get_serializer(), json.dumps)
+            self.assertEqual(
+                json.loads(''.join(utils.stream_json_object([(1, [2, 3])]))),
+                {'1': [2, 3]}
+            )
+
+        versions = ['a']
+        calls = []
+
+        @utils.encoded_once(lambda: (versions[0], None))
+        def payload(value):
+            """
+            Encodes value, recording calls.
+            """
+            calls.append(value)
+            return json.dumps(value)
+
+        self.assertIsInstance(payload(1), serialization.Payload)
+        self.assertEqual(payload(1), '1')
+        self.assertEqual(calls, [1])
+        versions[0] = 'b'
+        payload(1)
+        self.assertEqual(calls, [1, 1])
+
+        view = utils.jsonify(lambda: serialization.Payload('[1]'))
+        with main.app.test_request_context():
+            self.assertEqual(view().data, '[1]')
+
+    def test_weekday_of(self):
+        """
+        Test calculating weekday of date ordinal.
+        """
+        for day in range(1, 15):
+            sample_date = datetime.date(2013, 9, day)
+            self.assertEqual(
+                store.weekday_of(sample_date.toordinal()),
+                sample_date.weekday()
+            )
 
     def test_get_users(self):
         """
@@ -178,6 +987,39 @@ class PresenceAnalyzerUtilsTestCase(PresenceAnalyzerTestCase):
             }
         )
 
+    def test_users_directory(self):
+        """
+        Test users directory is cached until XML file changes.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'users.xml')
+        shutil.copy(main.app.config['USERS_XML'], path)
+        directory = users.get_directory(path)
+        self.assertEqual(len(directory), 3)
+        self.assertIs(users.get_directory(path), directory)
+        self.assertEqual(
+            json.loads(directory.payload(sort='name', per_page=1)),
+            [{
+                'user_id': 141,
+                'name': 'Adam P.',
+                'avatar_url': 'https://intranet.stxnext.pl:443'
+                              '/api/images/users/141',
+            }]
+        )
+
+        with open(path, 'w') as xml:
+            xml.write(
+                '<intranet><users><user id="1"><avatar>/1</avatar>'
+                '<name>A</name></user></users><server><host>h</host>'
+                '<port>80</port><protocol>http</protocol></server></intranet>'
+            )
+        directory = users.get_directory(path)
+        self.assertEqual(
+            directory.users,
+            {1: {'name': 'A', 'avatar_url': 'http://h:80/1'}}
+        )
+
     def test_start_end_grouped_by_weekday(self):
         """
         Test grouped start end presence by weekday.
@@ -190,7 +1032,7 @@ class PresenceAnalyzerUtilsTestCase(PresenceAnalyzerTestCase):
                 0: {'start': [33134], 'end': [57257]},
                 1: {'start': [33590], 'end': [50154]},
                 2: {'start': [33206], 'end': [58527]},
-                3: {'start': [37116, 34088], 'end': [60085, 57087]},
+                3: {'start': [34088, 37116], 'end': [57087, 60085]},
                 4: {'start': [47816], 'end': [54242]},
                 5: {'start': [], 'end': []},
                 6: {'start': [], 'end': []},
@@ -230,13 +1072,91 @@ class PresenceAnalyzerUtilsTestCase(PresenceAnalyzerTestCase):
                 [24123],
                 [16564],
                 [25321],
-                [22969, 22999],
+                [22999, 22969],
                 [6426],
                 [],
                 [],
             ]
         )
 
+    def test_weekday_index(self):
+        """
+        Test weekday stats built at load time match grouping of entries.
+        """
+        data = utils.get_data()
+        self.assertEqual(
+            data.weekday_index[11],
+            [
+                (1, 24123, 33134, 57257),
+                (1, 16564, 33590, 50154),
+                (1, 25321, 33206, 58527),
+                (2, 45968, 71204, 117172),
+                (1, 6426, 47816, 54242),
+                (0, 0, 0, 0),
+                (0, 0, 0, 0),
+            ]
+        )
+        for user_id in data:
+            stats = data.weekday_index[user_id]
+            grouped = utils.group_by_weekday(data[user_id])
+            self.assertEqual(
+                [item[1] for item in utils.mean_time_weekday(stats)],
+                [utils.mean(intervals) for intervals in grouped]
+            )
+            self.assertEqual(
+                [item[1:] for item in utils.presence_start_end(stats)],
+                [tuple(item) for item in utils.mean_start_end_by_weekday(
+                    utils.start_end_group_by_weekday(data[user_id]))]
+            )
+
+    def test_stream_json_object(self):
+        """
+        Test streaming of JSON object.
+        """
+        self.assertEqual(
+            json.loads(''.join(utils.stream_json_object(
+                [(1, [1, 2]), ('a', None)]))),
+            {'1': [1, 2], 'a': None}
+        )
+        self.assertEqual(''.join(utils.stream_json_object([])), '{}')
+
+    def test_metrics_render(self):
+        """
+        Test rendering metrics in Prometheus text format.
+        """
+        registry = metrics.Metrics()
+        registry.inc('rows', 2)
+        registry.inc('rows', 3)
+        registry.inc('hits', kind='a"b')
+        registry.observe('load', 0.5)
+        registry.observe('load', 0.25)
+        self.assertEqual(
+            registry.render(),
+            '# TYPE presence_analyzer_hits_total counter\n'
+            'presence_analyzer_hits_total{kind="a\\"b"} 1\n'
+            '# TYPE presence_analyzer_rows_total counter\n'
+            'presence_analyzer_rows_total 5\n'
+            '# TYPE presence_analyzer_load_seconds summary\n'
+            'presence_analyzer_load_seconds_count 2\n'
+            'presence_analyzer_load_seconds_sum 0.75\n'
+        )
+        registry.reset()
+        self.assertEqual(registry.render(), '\n')
+
+    def test_average(self):
+        """
+        Test calculating mean from sum and count.
+        """
+        self.assertEqual(aggregation.average(10, 4), 2.5)
+        self.assertEqual(aggregation.average(0, 0), 0)
+
+    def test_str_to_time(self):
+        """
+        Test formatting seconds from midnight as time.
+        """
+        self.assertEqual(utils.str_to_time(0), '00:00:00')
+        self.assertEqual(utils.str_to_time(34745.5), '09:39:05')
+
     def test_seconds_since_midnight(self):
         """
         Test calculating amount of seconds from midnight.
@@ -301,6 +1221,193 @@ class PresenceAnalyzerUtilsTestCase(PresenceAnalyzerTestCase):
         stub.i = 3
         self.assertEqual(stub(), 202)
 
+    def test_cache_stale_while_revalidate(self):
+        """
+        Test cache decorator serves stale value while refreshing it.
+        """
+        @utils.cache(1, stale_while_revalidate=True)
+        def stub():
+            """Stub method."""
+            stub.calls += 1
+            return 200 + stub.calls
+
+        stub.calls = 0
+        self.assertEqual(stub(), 201)
+        time.sleep(1.5)
+        self.assertEqual(stub(), 201)
+        for _ in range(50):
+            if stub() == 202:
+                break
+            time.sleep(0.02)
+        self.assertEqual(stub(), 202)
+        self.assertEqual(stub.calls, 2)
+
+    def test_cache_warm(self):
+        """
+        Test filling cache up front.
+        """
+        @utils.cache(1000)
+        def stub():
+            """Stub method."""
+            stub.calls += 1
+            return stub.calls
+
+        stub.calls = 0
+        stub.warm()
+        self.assertEqual(stub.calls, 1)
+        self.assertEqual(stub(), 1)
+        self.assertEqual(stub.calls, 1)
+
+    def test_warm_caches(self):
+        """
+        Test warming caches on startup loads CSV only for csv backend.
+        """
+        self.addCleanup(main.app.config.update, {
+            'DATA_CSV': main.app.config['DATA_CSV'],
+            'STORAGE_BACKEND': main.app.config.get('STORAGE_BACKEND', 'csv'),
+        })
+        main.app.config.update({
+            'DATA_CSV': os.path.join(tempfile.gettempdir(), 'missing.csv'),
+            'STORAGE_BACKEND': 'sqlite',
+        })
+        utils.warm_caches()
+        main.app.config['STORAGE_BACKEND'] = 'csv'
+        self.assertRaises(EnvironmentError, utils.warm_caches)
+
+    def test_cache_reload(self):
+        """
+        Test swapping in reloaded value of cache without expiry.
+        """
+        @utils.cache(lambda: None)
+        def stub():
+            """Stub method."""
+            stub.calls += 1
+            return stub.calls
+
+        stub.calls = 0
+        self.assertEqual(stub(), 1)
+        self.assertEqual(stub(), 1)
+        stub.reload()
+        self.assertEqual(stub.calls, 2)
+        self.assertEqual(stub(), 2)
+
+    def test_avatar_cache(self):
+        """
+        Test least recently used avatars are evicted above size limit.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cache = avatars.AvatarCache(tmp_dir, 10)
+        self.assertIsNone(cache.get('10'))
+        cache.put('10', {'etag': 'a'}, b'1234')
+        cache.put('11', {'etag': 'b'}, b'1234')
+        self.assertEqual(cache.get('10'), ({'etag': 'a'}, b'1234'))
+        cache.put('141', {'etag': 'c'}, b'1234')
+        self.assertIsNone(cache.get('11'))
+        self.assertEqual(cache.size, 8)
+        cache.put('141', {'etag': 'd'})
+        self.assertEqual(cache.get('141'), ({'etag': 'd'}, b'1234'))
+
+        cache = avatars.AvatarCache(tmp_dir, 10)
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(sorted(os.listdir(tmp_dir)),
+                         ['10', '10.json', '141', '141.json'])
+        cache.put('12', {'etag': 'e'}, b'x' * 20)
+        self.assertEqual(sorted(os.listdir(tmp_dir)), ['12', '12.json'])
+
+        proxy = avatars.AvatarProxy(cache, avatars.HTTPConnectionPool())
+        self.assertEqual(proxy.upstream_url('http://a.pl/x/1?s=2'),
+                         'http://a.pl/x/1?s=2')
+        proxy.upstream = 'http://127.0.0.1:8080'
+        self.assertEqual(proxy.upstream_url('http://a.pl/x/1?s=2'),
+                         'http://127.0.0.1:8080/x/1?s=2')
+        with self.assertRaises(avatars.UpstreamError):
+            proxy.pool.request('ftp://a.pl/x/1')
+
+    def test_avatar_pool_retry(self):
+        """
+        Test request is retried when upstream closed idle connection.
+        """
+        server = HTTPServer(('127.0.0.1', 0), KeepAliveAvatarHandler)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        AvatarHandler.paths = []
+        url = 'http://127.0.0.1:{0}/avatar'.format(server.server_address[1])
+
+        pool = avatars.HTTPConnectionPool(size=1)
+        self.assertEqual(pool.request(url)[2], AvatarHandler.image)
+        time.sleep(0.5)
+        self.assertEqual(pool.request(url)[2], AvatarHandler.image)
+        self.assertEqual(AvatarHandler.paths, ['/avatar', '/avatar'])
+
+    def test_file_watcher(self):
+        """
+        Test watcher calls callbacks of changed files only.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        first, second = [os.path.join(tmp_dir, name) for name in 'ab']
+        for path in first, second:
+            with open(path, 'w') as sample:
+                sample.write('1')
+        changed = []
+        watched = watcher.FileWatcher(
+            dict((path, partial(changed.append, path))
+                 for path in (first, second)),
+            interval=0.05,
+            use_inotify=False,
+        )
+        watched.check()
+        self.assertEqual(changed, [])
+
+        watched.start()
+        self.addCleanup(watched.join)
+        self.addCleanup(watched.stop)
+        with open(first, 'a') as sample:
+            sample.write('2')
+        replacement = os.path.join(tmp_dir, 'c')
+        with open(replacement, 'w') as sample:
+            sample.write('3')
+        os.rename(replacement, second)
+        for _ in range(100):
+            if len(changed) == 2:
+                break
+            time.sleep(0.05)
+        self.assertItemsEqual(changed, [first, second])
+
+        os.remove(first)
+        watched.check()
+        self.assertEqual(len(changed), 2)
+
+    def test_watch_files(self):
+        """
+        Test presence data is reloaded when the file changes.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(main.app.config['DATA_CSV'], path)
+        self.addCleanup(utils.get_data.reload)
+        self.addCleanup(main.app.config.update,
+                        {'DATA_CSV': main.app.config['DATA_CSV']})
+        main.app.config.update({'DATA_CSV': path, 'WATCH_INTERVAL': 0.05})
+        utils.get_data.reload()
+        self.assertNotIn(12, utils.get_data())
+
+        watched = utils.watch_files()
+        self.addCleanup(watched.join)
+        self.addCleanup(watched.stop)
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        for _ in range(100):
+            if 12 in utils.get_data():
+                break
+            time.sleep(0.05)
+        self.assertIn(12, utils.get_data())
+
     def test_cache_diffrent_functions(self):
         """
         Test cache decorator can cache results of diffrent functions.
@@ -322,6 +1429,435 @@ class PresenceAnalyzerUtilsTestCase(PresenceAnalyzerTestCase):
         self.assertEqual(stub2(), [1, 2])
 
 
+class PresenceAnalyzerLoaderTestCase(PresenceAnalyzerTestCase):
+    """
+    CSV loader tests.
+    """
+    def test_parse_line(self):
+        """
+        Test parsing of lines in fixed layout.
+        """
+        ordinals = {}
+        self.assertEqual(
+            loader.parse_line('10,2013-09-10,09:39:05,17:59:52\r\n', ordinals),
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792)
+        )
+        self.assertEqual(
+            ordinals,
+            {'2013-09-10': datetime.date(2013, 9, 10).toordinal()}
+        )
+        self.assertIsNone(loader.parse_line('10,2013-9-10,9:39:05,17:59:52',
+                                            ordinals))
+        self.assertIsNone(loader.parse_line('10,2013-09-10,24:39:05,17:59:52',
+                                            ordinals))
+        self.assertIsNone(loader.parse_line('10,2013-02-30,09:39:05,17:59:52',
+                                            ordinals))
+        self.assertIsNone(loader.parse_line('user_id,date,start,end',
+                                            ordinals))
+        for line in ('10,2013-09-1 ,09:39:05,17:59:52',
+                     '10,2013-09-10,-1:00:00,17:59:52',
+                     '10,2013-09-10,09:-1:05,17:59:52',
+                     '10,2013-09-10, 9:00:00,17:59:52',
+                     '10,2013-09-10,+9:00:00,17:59:52'):
+            self.assertIsNone(loader.parse_line(line, ordinals))
+            self.assertEqual(list(loader.parse_rows([line], fast=False)), [])
+            self.assertEqual(list(loader.parse_rows([line])), [])
+
+    def test_parse_rows(self):
+        """
+        Test fast path matches csv/strptime path, including fallbacks.
+        """
+        lines = [
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\n',
+            '11,2013-9-5,9:28:08,15:51:27\n',
+            '11,2013-09-31,09:28:08,15:51:27\n',
+            '"12",2013-09-05,09:28:08,15:51:27\n',
+            '\n',
+            'footer\n',
+        ]
+        expected = [
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792),
+            (11, datetime.date(2013, 9, 5).toordinal(), 34088, 57087),
+            (12, datetime.date(2013, 9, 5).toordinal(), 34088, 57087),
+        ]
+        self.assertEqual(list(loader.parse_rows(lines)), expected)
+        self.assertEqual(list(loader.parse_rows(lines, fast=False)), expected)
+
+    def test_incremental_loader(self):
+        """
+        Test loader parses only appended rows and reloads replaced file.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,09:39:05,17:59:52\n')
+        incremental = loader.IncrementalLoader(path)
+        data = incremental.load()
+        self.assertItemsEqual(data.keys(), [10])
+        self.assertIs(incremental.load(), data)
+        version = data.version
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('11,2013-09-05,09:28:08,15:51:27\n'
+                          '10,2013-09-10,10:00:00,17:59:52\n'
+                          '10,2013-09-09,08:00:')
+        data = incremental.load()
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertNotEqual(data.version, version)
+        self.assertEqual(list(data[10].starts), [36000])
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('00,17:00:00\n')
+        data = incremental.load()
+        self.assertEqual(list(data[10].starts), [28800, 36000])
+
+        os.rename(path, path + '.old')
+        with open(path, 'w') as csvfile:
+            csvfile.write('12,2013-09-10,09:39:05,17:59:52\n')
+        self.assertItemsEqual(incremental.load().keys(), [12])
+
+        with open(path, 'w') as csvfile:
+            csvfile.write('')
+        self.assertItemsEqual(incremental.load().keys(), [])
+
+        with open(path, 'w') as csvfile:
+            csvfile.write('12,2013-09-10,09:39:05,17:59:52\n')
+        incremental.load()
+        # rewritten in place and grown
+        with open(path, 'w') as csvfile:
+            csvfile.write('13,2013-09-10,09:39:05,17:59:52\n'
+                          '13,2013-09-11,09:39:05,17:59:52\n')
+        data = incremental.load()
+        self.assertItemsEqual(data.keys(), [13])
+        self.assertEqual(len(data[13].dates), 2)
+
+        # concurrent loads read appended rows once
+        with open(path, 'a') as csvfile:
+            csvfile.write(''.join(
+                '13,2013-10-{0:02d},09:00:00,17:00:00\n'.format(day)
+                for day in range(1, 29)))
+        threads = [Thread(target=incremental.load) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(incremental.load()[13].dates), 30)
+        self.assertEqual(incremental.checkpoint()[1],
+                         os.path.getsize(path))
+
+    def test_get_loader(self):
+        """
+        Test concurrent first calls share one loader of the file.
+        """
+        path = os.path.join(tempfile.gettempdir(), 'missing-data.csv')
+        # pylint: disable=protected-access
+        self.addCleanup(loader._LOADERS.pop, path, None)
+        results = []
+        threads = [
+            Thread(target=lambda: results.append(loader.get_loader(path)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertEqual(len(set(id(item) for item in results)), 1)
+        self.assertIs(loader.get_loader(path), results[0])
+
+    def test_snapshot(self):
+        """
+        Test writing and mapping binary snapshot of presence data.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        snapshot_path = os.path.join(tmp_dir, 'data.snapshot')
+        shutil.copy(main.app.config['DATA_CSV'], path)
+        incremental = loader.IncrementalLoader(path)
+        incremental.load()
+        snapshot.write_snapshot(snapshot_path, *incremental.checkpoint())
+        expected, expected_offset, expected_identity = \
+            incremental.checkpoint()
+
+        data, offset, identity = snapshot.read_snapshot(snapshot_path)
+        self.assertEqual(offset, expected_offset)
+        self.assertEqual(identity, expected_identity)
+        self.assertEqual(list(data.user_ids), list(expected.user_ids))
+        self.assertEqual(list(data.bounds), list(expected.bounds))
+        self.assertEqual(list(data.starts), list(expected.starts))
+        self.assertEqual(data.weekday_index, expected.weekday_index)
+        self.assertEqual(list(data[11].ends), list(expected[11].ends))
+        self.assertEqual(data.dates[-1], expected.dates[-1])
+        self.assertIn(datetime.date(2013, 9, 10), data[10])
+
+        # last line of test data has no newline, it's read after seeding
+        seeded = loader.IncrementalLoader(path)
+        seeded.seed(data, offset, identity)
+        self.assertEqual(
+            seeded.load().weekday_index,
+            incremental.load().weekday_index
+        )
+        self.assertIs(seeded.load(), seeded.load())
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:39:05,17:59:52\n')
+        self.assertItemsEqual(seeded.load().keys(), [10, 11, 12])
+        # mapped arrays aren't copied by appended rows
+        self.assertIs(seeded.load().base, data)
+        self.assertEqual(seeded.load().weekday_index,
+                         loader.load_store(path).weekday_index)
+
+        with open(snapshot_path, 'wb') as output:
+            output.write(b'garbage')
+        self.assertRaises(snapshot.SnapshotError,
+                          snapshot.read_snapshot, snapshot_path)
+
+    def test_split_file(self):
+        """
+        Test splitting file into newline aligned byte ranges.
+        """
+        path = main.app.config['DATA_CSV']
+        size = os.path.getsize(path)
+        with open(path, 'rb') as csvfile:
+            content = csvfile.read()
+        for chunks in (1, 2, 3, 100):
+            ranges = loader.split_file(path, chunks)
+            self.assertLessEqual(len(ranges), chunks)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], size)
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, start)
+                self.assertEqual(content[start - 1], b'\n')
+
+    def test_load_store_parallel(self):
+        """
+        Test parsing file in worker processes gives the same store.
+        """
+        path = os.path.join('runtime', 'data', 'sample_data.csv')
+        expected = loader.load_store(path)
+        data, offset = loader.load_store_parallel(path, 3)
+        self.assertEqual(offset, os.path.getsize(path))
+        self.assertEqual(list(data.user_ids), list(expected.user_ids))
+        self.assertEqual(list(data.bounds), list(expected.bounds))
+        self.assertEqual(list(data.dates), list(expected.dates))
+        self.assertEqual(list(data.starts), list(expected.starts))
+        self.assertEqual(list(data.ends), list(expected.ends))
+        self.assertEqual(data.weekday_index, expected.weekday_index)
+
+        incremental = loader.IncrementalLoader(main.app.config['DATA_CSV'],
+                                               workers=2)
+        self.assertEqual(
+            incremental.load().weekday_index,
+            utils.get_data().weekday_index
+        )
+
+        # no worker processes are forked while other threads run
+        def forbidden(*args):
+            """
+            Fails test when called.
+            """
+            raise AssertionError('Pool forked from threaded process')
+        self.addCleanup(setattr, loader, 'load_store_parallel',
+                        loader.load_store_parallel)
+        loader.load_store_parallel = forbidden
+        running = Event()
+        self.addCleanup(running.set)
+        Thread(target=running.wait).start()
+        incremental = loader.IncrementalLoader(main.app.config['DATA_CSV'],
+                                               workers=2)
+        self.assertEqual(
+            incremental.load().weekday_index,
+            utils.get_data().weekday_index
+        )
+
+    def test_weekday_ranges(self):
+        """
+        Test weekday stats of date ranges match filtering of entries.
+        """
+        data = loader.load_store(
+            os.path.join('runtime', 'data', 'sample_data.csv'))
+        user_id = data.keys()[0]
+        dates = list(data[user_id].dates)
+        for first, last in ((None, None), (dates[10], None),
+                            (None, dates[-10]), (dates[5], dates[50]),
+                            (dates[5] + 1, dates[5] + 1), (1, 2)):
+            rows = [
+                row for row in data[user_id].rows()
+                if (first is None or row[0] >= first) and
+                (last is None or row[0] <= last)
+            ]
+            self.assertEqual(
+                data.weekday_stats(user_id, first, last),
+                store.weekday_stats(rows)
+            )
+        summary = loader.load_summary(main.app.config['DATA_CSV'])
+        self.assertEqual(summary.weekday_stats(10),
+                         summary.weekday_index[10])
+        self.assertRaises(ValueError, summary.weekday_stats, 10, 1, None)
+
+        # ranges are kept for limited number of users
+        self.addCleanup(setattr, store, 'USER_CACHE_SIZE',
+                        store.USER_CACHE_SIZE)
+        store.USER_CACHE_SIZE = 2
+        # pylint: disable=protected-access
+        for user_id in data:
+            data.weekday_stats(user_id, dates[10])
+            data.weekday_distribution(user_id)
+            self.assertLessEqual(len(data._ranges), 2)
+            self.assertLessEqual(len(data._distributions), 2)
+            self.assertIn(user_id, data._ranges)
+
+    def test_sqlite_backend(self):
+        """
+        Test importing CSV into SQLite and aggregating it there.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        db_path = os.path.join(tmp_dir, 'presence.sqlite')
+        csv_path = os.path.join('runtime', 'data', 'sample_data.csv')
+        self.assertEqual(backends.import_csv(db_path, csv_path), 15188)
+
+        expected = loader.load_store(csv_path)
+        backend = backends.SqliteBackend(db_path, pool_size=2)
+        self.addCleanup(backend.pool.close)
+        self.assertEqual(list(backend), expected.keys())
+        self.assertIn(expected.keys()[0], backend)
+        self.assertNotIn(-1, backend)
+        self.assertEqual(
+            backend.version,
+            loader.file_version(os.stat(csv_path))[0]
+        )
+        self.assertEqual(
+            backend.last_modified,
+            loader.file_version(os.stat(csv_path))[1]
+        )
+        for user_id in expected:
+            self.assertEqual(
+                backend.weekday_stats(user_id),
+                expected.weekday_index[user_id]
+            )
+        user_id = expected.keys()[0]
+        first, last = expected[user_id].dates[5], expected[user_id].dates[50]
+        self.assertEqual(
+            backend.weekday_stats(user_id, first, last),
+            expected.weekday_stats(user_id, first, last)
+        )
+
+    def test_store_combine(self):
+        """
+        Test combining stores, later ones win for the same user and date.
+        """
+        first = store.PresenceStore.from_rows([
+            (1, 735000, 10, 20),
+            (2, 735000, 10, 20),
+        ])
+        second = store.PresenceStore.from_rows([
+            (2, 735000, 30, 40),
+            (2, 735001, 30, 40),
+            (3, 735000, 50, 60),
+        ])
+        combined = store.PresenceStore.combine([first, second])
+        self.assertEqual(list(combined.user_ids), [1, 2, 3])
+        self.assertEqual(list(combined.bounds), [0, 1, 3, 4])
+        self.assertEqual(list(combined.starts), [10, 30, 30, 50])
+        self.assertIs(combined.weekday_index[3], second.weekday_index[3])
+        self.assertEqual(
+            combined.weekday_index[2],
+            store.weekday_stats(combined[2].rows())
+        )
+
+    def test_load_summary(self):
+        """
+        Test streaming aggregation gives the same results as full load.
+        """
+        for path in (main.app.config['DATA_CSV'],
+                     os.path.join('runtime', 'data', 'sample_data.csv')):
+            summary = loader.load_summary(path)
+            expected = loader.load_store(path)
+            self.assertEqual(summary.keys(), expected.keys())
+            self.assertEqual(summary.weekday_index, expected.weekday_index)
+            self.assertIsNotNone(summary.version)
+        self.assertIn(10, summary)
+        self.assertNotIn(1, summary)
+
+        # the last entry of user and date wins, like in PresenceStore
+        rows = [
+            (10, 735000, 100, 200),
+            (10, 735001, 100, 200),
+            (10, 735000, 300, 500),
+            (11, 735000, 100, 200),
+        ]
+        self.assertEqual(
+            store.PresenceSummary.from_rows(rows).weekday_index,
+            store.PresenceStore.from_rows(rows).weekday_index
+        )
+
+    def test_store_merge(self):
+        """
+        Test merging new rows into presence store.
+        """
+        data = store.PresenceStore.from_rows([
+            (1, 735000, 10, 20),
+            (2, 735000, 10, 20),
+            (2, 735002, 10, 20),
+        ])
+        merged = data.merge([(2, 735001, 30, 40), (2, 735002, 50, 60),
+                             (3, 735000, 70, 80)])
+        self.assertEqual(list(merged.user_ids), [1, 2, 3])
+        self.assertEqual(list(merged.bounds), [0, 1, 4, 5])
+        self.assertEqual(list(merged.dates),
+                         [735000, 735000, 735001, 735002, 735000])
+        self.assertEqual(list(merged.starts), [10, 10, 30, 50, 70])
+        self.assertIs(merged.weekday_index[1], data.weekday_index[1])
+        self.assertEqual(
+            merged.weekday_index[2],
+            store.weekday_stats(merged[2].rows())
+        )
+        self.assertIs(data.merge([]), data)
+
+    def test_layered_store(self):
+        """
+        Test rows merged into shared store are kept in overlay.
+        """
+        rows = [(1, 735000 + day, 10, 20) for day in range(8)] + [
+            (2, 735000, 10, 20),
+            (2, 735002, 10, 20),
+        ]
+        data = store.PresenceStore.from_rows(rows)
+        data.shared = True
+        new_rows = [(2, 735001, 30, 40), (2, 735002, 50, 60)]
+        layered = data.merge(new_rows[:1]).merge(new_rows[1:])
+        self.assertIsInstance(layered, store.LayeredStore)
+        self.assertIs(layered.base, data)
+        expected = store.PresenceStore.from_rows(rows + new_rows)
+        self.assertEqual(layered.keys(), [1, 2])
+        self.assertIn(2, layered)
+        self.assertNotIn(3, layered)
+        self.assertEqual(layered.weekday_index, expected.weekday_index)
+        self.assertEqual(list(layered[2].starts), [10, 30, 50])
+        for user_id in (1, 2):
+            self.assertEqual(layered.weekday_stats(user_id, 735001, 735003),
+                             expected.weekday_stats(user_id, 735001, 735003))
+            self.assertEqual(
+                layered.weekday_distribution(user_id, 735001).values,
+                expected.weekday_distribution(user_id, 735001).values
+            )
+        flat = layered.flatten()
+        self.assertEqual(list(flat.starts), list(expected.starts))
+
+        # large overlay is combined into private store
+        combined = layered.merge([(3, 735000 + day, 10, 20)
+                                  for day in range(4)])
+        self.assertIsInstance(combined, store.PresenceStore)
+        self.assertEqual(combined.keys(), [1, 2, 3])
+        self.assertIsInstance(
+            store.PresenceStore.from_rows(rows).merge(new_rows),
+            store.PresenceStore
+        )
+
+
 def suite():
     """
     Default test suite.
@@ -329,6 +1865,7 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
     return base_suite
 
 
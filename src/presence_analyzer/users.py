@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Users directory parsed from XML file.
+"""
+from __future__ import unicode_literals
+
+import os
+from json import dumps
+from threading import Lock
+from lxml.etree import iterparse
+
+from presence_analyzer.loader import file_version
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SORT_KEYS = {
+    'user_id': lambda user: user['user_id'],
+    'name': lambda user: (user['name'].lower(), user['user_id']),
+}
+
+
+def _get_server_url(element):
+    """
+    Extract server url from xml element.
+    """
+    protocol = element.find('protocol').text
+    host = element.find('host').text
+    port = element.find('port').text
+    return '{0}://{1}:{2}'.format(protocol, host, port)
+
+
+def parse_users(path):
+    """
+    Parses users XML file incrementally, clearing processed elements.
+
+    Returns list of dicts with user_id, name, avatar_url and groups keys;
+    groups are texts of optional <group> elements of user.
+    """
+    server_url = ''
+    users = []
+    for i, (_, elem) in enumerate(iterparse(path, tag=('server', 'user'))):
+        if elem.tag == 'server':
+            server_url = _get_server_url(elem)
+            continue
+        try:
+            users.append({
+                'user_id': int(elem.attrib['id']),
+                'name': unicode(elem.find('name').text),
+                'avatar': elem.find('avatar').text,
+                'groups': [
+                    group.text.strip() for group in elem.iterfind('group')
+                    if group.text and group.text.strip()
+                ],
+            })
+        except (KeyError, AttributeError, ValueError):
+            log.debug('Problem with user %d: ', i, exc_info=True)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    # server element usually precedes users, but don't rely on it
+    for user in users:
+        user['avatar_url'] = '{0}{1}'.format(server_url, user.pop('avatar'))
+    return users
+
+
+class UsersDirectory(object):
+    """
+    Users parsed from XML file with dropdown payloads serialized up front.
+
+    Every user is encoded to JSON once; sorted and paged listings are built
+    by joining already encoded entries. groups maps names of groups to
+    sorted ids of their members.
+    """
+    def __init__(self, users, version=None):
+        self.version = version
+        self.groups = {}
+        users = [dict(user) for user in users]
+        for user in users:
+            for group in user.pop('groups', ()):
+                self.groups.setdefault(group, []).append(user['user_id'])
+        for members in self.groups.itervalues():
+            members.sort()
+        self.users = dict(
+            (user['user_id'], {
+                'name': user['name'],
+                'avatar_url': user['avatar_url'],
+            })
+            for user in users
+        )
+        self._encoded = {}
+        for sort, key in SORT_KEYS.iteritems():
+            ordered = sorted(users, key=key)
+            self._encoded[sort] = [dumps(user) for user in ordered]
+
+    def __len__(self):
+        return len(self.users)
+
+    def payload(self, sort='user_id', page=1, per_page=None):
+        """
+        Returns JSON list of users for dropdown.
+
+        `sort` is one of SORT_KEYS, optionally prefixed with '-' for
+        descending order. Pages are numbered from 1. Raises ValueError for
+        unknown sort key or invalid page.
+        """
+        if sort.lstrip('-') not in self._encoded:
+            raise ValueError('Unknown sort key: {0}'.format(sort))
+        encoded = self._encoded[sort.lstrip('-')]
+        if page < 1 or (per_page is not None and per_page < 1):
+            raise ValueError('Invalid page: {0} {1}'.format(page, per_page))
+        if sort.startswith('-'):
+            encoded = encoded[::-1]
+        if per_page is not None:
+            encoded = encoded[(page - 1) * per_page:page * per_page]
+        return '[{0}]'.format(', '.join(encoded))
+
+
+_DIRECTORIES = {}
+_LOCK = Lock()
+
+
+def get_directory(path):
+    """
+    Returns UsersDirectory of given file, parsing it again only when the
+    file has changed since last call.
+    """
+    version = file_version(os.stat(path))[0]
+    with _LOCK:
+        directory = _DIRECTORIES.get(path)
+        if directory is None or directory.version != version:
+            directory = UsersDirectory(parse_users(path), version)
+            _DIRECTORIES[path] = directory
+        return directory
@@ -4,16 +4,36 @@ Helper functions used in views.
 """
 from __future__ import unicode_literals
 
-import csv
-from json import dumps
+import calendar
+import json
+import os
+from hashlib import sha1
 from functools import wraps
+from itertools import islice
 from datetime import datetime, timedelta
-from lxml.etree import parse
 from collections import deque
-from threading import Lock
-from flask import Response
+from threading import Lock, Thread
+from flask import Response, copy_current_request_context, request
 
 from presence_analyzer.main import app
+from presence_analyzer.metrics import inc, timer
+from presence_analyzer.serialization import (
+    Payload,
+    compress_response,
+    dumps,
+    get_serializer,
+)
+from presence_analyzer.aggregation import format_seconds, user_series
+from presence_analyzer.avatars import get_avatar_proxy
+from presence_analyzer.backends import get_sqlite_backend
+from presence_analyzer.loader import file_version, get_loader, load_summary
+from presence_analyzer.store import (
+    WeekdayDistribution,
+    seconds_since_midnight,
+    weekday_of,
+)
+from presence_analyzer.users import get_directory
+from presence_analyzer.watcher import FileWatcher
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -22,22 +42,282 @@ log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Payload results are already encoded and sent as they are.
     """
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
-        )
+        result = function(*args, **kwargs)
+        if isinstance(result, Payload):
+            return Response(result, mimetype='application/json')
+        with timer('serialization'):
+            body = dumps(result)
+        return Response(body, mimetype='application/json')
     return inner
 
 
-def cache(cache_time):
+def stream_json_object(items):
+    """
+    Returns iterator of JSON object built from (key, value) pairs chunk by
+    chunk.
+
+    Serializer is chosen up front, the chunks are produced outside of
+    request context.
+    """
+    serialize = get_serializer()
+
+    def chunks():
+        """
+        Yields encoded chunks.
+        """
+        yield '{'
+        separator = ''
+        for key, value in items:
+            yield '{0}{1}: {2}'.format(
+                separator, serialize(unicode(key)), serialize(value))
+            separator = ', '
+        yield '}'
+    return chunks()
+
+
+def encoded_once(version, maxsize=64):
+    """
+    Caches Payload returned by wrapped function per data version.
+
+    `version` is like in cached_response; results are keyed by arguments
+    of wrapped function, which builds the payload only on first call after
+    data has changed.
+    """
+    def decorator(function):
+        payloads = {'version': None, 'items': {}}
+        lock = Lock()
+
+        @wraps(function)
+        def inner(*args):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            tag = version()[0]
+            with lock:
+                if payloads['version'] != tag:
+                    payloads['version'] = tag
+                    payloads['items'] = {}
+                payload = payloads['items'].get(args)
+            if payload is None:
+                with timer('serialization'):
+                    payload = Payload(function(*args))
+                with lock:
+                    if payloads['version'] == tag:
+                        if len(payloads['items']) >= maxsize:
+                            payloads['items'] = {}
+                        payloads['items'][args] = payload
+            return payload
+        return inner
+    return decorator
+
+
+def offload(function, *args, **kwargs):
+    """
+    Calls blocking function in executor registered as
+    app.extensions['executor'] (see evented.serve), carrying request
+    context over. Without executor function is called directly.
+    """
+    executor = app.extensions.get('executor')
+    if executor is None:
+        return function(*args, **kwargs)
+    return executor.apply(copy_current_request_context(function), args, kwargs)
+
+
+def offload_iter(iterator, batch=64):
+    """
+    Returns iterator whose items are computed in executor (see offload),
+    `batch` items at a time, e.g. for streamed responses.
+
+    Batches run after the view has returned, without request context, so
+    the iterator must not need one.
+    """
+    executor = app.extensions.get('executor')
+    if executor is None:
+        return iterator
+    iterator = iter(iterator)
+
+    def batches():
+        """
+        Yields items of batches taken from iterator in executor.
+        """
+        while True:
+            items = executor.apply(lambda: list(islice(iterator, batch)))
+            if not items:
+                return
+            for item in items:
+                yield item
+    return batches()
+
+
+def spawn(function, name):
+    """
+    Runs function in background, in executor when one is registered, in
+    new daemon thread otherwise.
+    """
+    executor = app.extensions.get('executor')
+    if executor is not None:
+        executor.spawn(function)
+        return
+    thread = Thread(target=function, name=name)
+    thread.daemon = True
+    thread.start()
+
+
+def cached_response(version, maxsize=4096):
+    """
+    Caches serialized responses of wrapped view per data version.
+
+    `version` returns (version tag, last modified datetime) of data the view
+    is based on. Responses are keyed by view arguments, query string and
+    version; they carry strong ETag and Last-Modified headers and
+    conditional requests are answered with 304 Not Modified. Compressed
+    variants of large bodies are cached alongside, see compress_response.
+    Missing responses are computed by offload().
+    """
+    def decorator(function):
+        responses = {'version': None, 'items': {}}
+        lock = Lock()
+
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            tag, last_modified = version()
+            key = (
+                function.__name__,
+                args,
+                tuple(sorted(kwargs.items())),
+                request.query_string,
+            )
+            with lock:
+                if responses['version'] != tag:
+                    responses['version'] = tag
+                    responses['items'] = {}
+                cached = responses['items'].get(key)
+            inc('response_cache_requests',
+                result='miss' if cached is None else 'hit')
+            if cached is None:
+                response = offload(function, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                etag = sha1(repr((tag, key)).encode('utf-8')).hexdigest()
+                cached = (response.get_data(), response.mimetype, etag, {})
+                with lock:
+                    if responses['version'] == tag:
+                        if len(responses['items']) >= maxsize:
+                            responses['items'] = {}
+                        responses['items'][key] = cached
+
+            body, mimetype, etag, variants = cached
+            response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            compress_response(response, variants)
+            return response.make_conditional(request)
+        return inner
+    return decorator
+
+
+def data_version():
+    """
+    Returns version tag and last modification time of presence data.
+    """
+    data = get_backend()
+    return data.version, data.last_modified
+
+
+def users_version():
+    """
+    Returns version tag and last modification time of users file.
+    """
+    return file_version(os.stat(app.config['USERS_XML']))
+
+
+def get_users_directory():
+    """
+    Returns UsersDirectory of USERS_XML file.
+    """
+    return get_directory(app.config['USERS_XML'])
+
+
+def combined_version(*versions):
+    """
+    Returns version tag and last modification time of result built from
+    sources with given (version tag, last modified) versions.
+    """
+    modified = [item for _, item in versions if item is not None]
+    return (
+        '-'.join(unicode(tag) for tag, _ in versions),
+        max(modified) if modified else None,
+    )
+
+
+def dashboard_version():
+    """
+    Returns version of results combining presence data and users file.
+    """
+    return combined_version(data_version(), users_version())
+
+
+def groups_version():
+    """
+    Returns version tag and last modification time of group rollups, which
+    depend on presence data, users file and optional GROUPS_FILE.
+    """
+    versions = [data_version(), users_version()]
+    if app.config.get('GROUPS_FILE'):
+        versions.append(file_version(os.stat(app.config['GROUPS_FILE'])))
+    return combined_version(*versions)
+
+
+def get_groups():
+    """
+    Returns dict mapping group names to sorted ids of their members.
+
+    Groups are defined by <group> elements of users in USERS_XML and by
+    optional GROUPS_FILE, JSON object mapping group names to lists of user
+    ids; members of groups defined in both places are joined.
+    """
+    groups = dict(
+        (name, set(members))
+        for name, members in get_users_directory().groups.iteritems()
+    )
+    if app.config.get('GROUPS_FILE'):
+        with open(app.config['GROUPS_FILE']) as groups_file:
+            defined = json.load(groups_file)
+        for name, members in defined.iteritems():
+            try:
+                members = set(int(user_id) for user_id in members)
+            except (TypeError, ValueError):
+                log.warning('Invalid members of group %s', name)
+                continue
+            groups.setdefault(name, set()).update(members)
+    return dict(
+        (name, sorted(members)) for name, members in groups.iteritems()
+    )
+
+
+def cache(cache_time, stale_while_revalidate=False):
     """
     Cache result of func for period of cache_time (in s).
+
+    `cache_time` may also be a function returning the period, None means
+    the result never expires and is replaced only by reload().
+    With stale_while_revalidate expired result is still returned while one
+    background thread (see spawn) recomputes it, so only the very first
+    call waits. Wrapped function gets warm() method which fills the cache
+    up front and reload() method which recomputes the result and swaps it
+    in while callers still get the previous one.
     """
     def decorator(func):
         fn_name = func.__name__
@@ -46,71 +326,194 @@ def cache(cache_time):
         cache.setdefault(fn_name, {
             'memo': deque(maxlen=1),
             'valid': deque(maxlen=1),
+            'refreshing': False,
         })
         lock = Lock()
+        reload_lock = Lock()
+
+        def expiry(now):
+            """
+            Returns time when result computed now expires.
+            """
+            seconds = cache_time() if callable(cache_time) else cache_time
+            if seconds is None:
+                return datetime.max
+            return now + timedelta(0, seconds)
+
+        def compute():
+            """
+            Calls wrapped function, timing it.
+            """
+            with timer('cache_compute', function=fn_name):
+                return func()
+
+        def store(value, valid_to):
+            """
+            Saves computed value.
+            """
+            cache[fn_name]['valid'].append(valid_to)
+            cache[fn_name]['memo'].append(value)
+
+        def reload():
+            """
+            Recomputes value and swaps it in.
+            """
+            with reload_lock:
+                valid_to = expiry(datetime.now())
+                value = compute()
+                with lock:
+                    store(value, valid_to)
+
+        def refresh():
+            """
+            Recomputes value in background thread.
+            """
+            try:
+                reload()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Background refresh of %s failed', fn_name)
+            finally:
+                cache[fn_name]['refreshing'] = False
 
         @wraps(func)
         def wraper():
             now = datetime.now()
-            valid_to = now + timedelta(0, cache_time)
-            with lock:
-                if not cache[fn_name]['memo'] or \
-                   now > cache[fn_name]['valid'][0]:
-                    cache[fn_name]['valid'].append(valid_to)
-                    cache[fn_name]['memo'].append(func())
+            with timer('cache_lock_wait', function=fn_name):
+                lock.acquire()
+            try:
+                if cache[fn_name]['memo'] and \
+                   now > cache[fn_name]['valid'][0] and \
+                   stale_while_revalidate:
+                    inc('cache_requests', function=fn_name, result='stale')
+                    if not cache[fn_name]['refreshing']:
+                        cache[fn_name]['refreshing'] = True
+                        spawn(refresh, fn_name)
+                elif not cache[fn_name]['memo'] or \
+                        now > cache[fn_name]['valid'][0]:
+                    inc('cache_requests', function=fn_name, result='miss')
+                    store(compute(), expiry(now))
+                else:
+                    inc('cache_requests', function=fn_name, result='hit')
                 return cache[fn_name]['memo'][0]
+            finally:
+                lock.release()
+
+        def warm():
+            """
+            Computes and caches value of wrapped function.
+            """
+            with lock:
+                store(compute(), expiry(datetime.now()))
+
+        wraper.warm = warm
+        wraper.reload = reload
         return wraper
     return decorator
 
 
-@cache(600)
+@cache(lambda: app.config.get('DATA_CACHE_TTL', 600),
+       stale_while_revalidate=True)
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
-
-    It creates structure like this:
-    data = {
-        'user_id': {
-            datetime.date(2013, 10, 1): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
-        }
+    Extracts presence data from CSV file into PresenceStore.
+
+    Result is kept for DATA_CACHE_TTL seconds (None keeps it until reloaded
+    by watcher started by watch_files()).
+
+    Rows appended to the file since the previous call are merged into data
+    loaded before, see IncrementalLoader. When DATA_SNAPSHOT is configured
+    the first call maps snapshot written by `bin/flask-ctl snapshot`.
+    Full reloads are parsed by LOADER_WORKERS processes while no other
+    threads run, e.g. during warm-up on startup.
+
+    Entries are grouped by user_id and can be accessed like this:
+    data = get_data()
+    data[10].dates   # array of date ordinals, sorted
+    data[10].starts  # array of start times (seconds since midnight)
+    data[10].ends    # array of end times (seconds since midnight)
+    data[10][datetime.date(2013, 10, 1)] == {
+        'start': datetime.time(9, 0, 0),
+        'end': datetime.time(17, 30, 0),
     }
+
+    With DATA_STREAMING enabled only PresenceSummary (weekday stats without
+    per-day entries) is built, keeping memory use independent of file size.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=str(','))
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    if app.config.get('DATA_STREAMING'):
+        return load_summary(app.config['DATA_CSV'])
+    return get_loader(
+        app.config['DATA_CSV'],
+        app.config.get('DATA_SNAPSHOT'),
+        app.config.get('LOADER_WORKERS', 1),
+    ).load()
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def get_backend():
+    """
+    Returns presence data backend chosen by STORAGE_BACKEND setting.
 
-    return data
+    'csv' (default) is data returned by get_data(), 'sqlite' queries
+    SQLITE_DB database filled by `bin/flask-ctl import_sqlite`.
+    """
+    if app.config.get('STORAGE_BACKEND', 'csv') == 'sqlite':
+        return get_sqlite_backend(
+            app.config['SQLITE_DB'],
+            app.config.get('SQLITE_POOL_SIZE', 5),
+        )
+    return get_data()
 
 
-def _get_server_url(element):
+def get_avatars():
     """
-    Extract server url from xml element.
+    Returns AvatarProxy configured by AVATAR_* settings.
+
+    AVATAR_UPSTREAM (scheme://host:port) replaces server of avatar URLs
+    from users file, AVATAR_CACHE_SIZE limits bytes kept in
+    AVATAR_CACHE_DIR.
     """
-    protocol = element.find('protocol').text
-    host = element.find('host').text
-    port = element.find('port').text
-    return '{0}://{1}:{2}'.format(protocol, host, port)
+    return get_avatar_proxy(
+        app.config['AVATAR_CACHE_DIR'],
+        app.config.get('AVATAR_CACHE_SIZE', 50 * 1024 * 1024),
+        app.config.get('AVATAR_UPSTREAM'),
+        app.config.get('AVATAR_POOL_SIZE', 4),
+        app.config.get('AVATAR_TIMEOUT', 5.0),
+        app.config.get('AVATAR_REVALIDATE', 86400),
+    )
+
+
+def uses_csv_data():
+    """
+    Tells whether presence data comes from DATA_CSV (STORAGE_BACKEND 'csv').
+    """
+    return app.config.get('STORAGE_BACKEND', 'csv') == 'csv'
+
+
+def warm_caches():
+    """
+    Loads presence data (csv backend only) and users directory before
+    requests arrive.
+
+    Missing users file is only logged, it may be downloaded later.
+    """
+    if uses_csv_data():
+        get_data.warm()
+    try:
+        get_users_directory()
+    except EnvironmentError:
+        log.warning('Users directory not loaded', exc_info=True)
+
+
+def watch_files():
+    """
+    Starts FileWatcher reloading presence data and users directory as soon
+    as DATA_CSV or USERS_XML change. Returns the watcher.
+    """
+    callbacks = {app.config['USERS_XML']: get_users_directory}
+    if uses_csv_data():
+        callbacks[app.config['DATA_CSV']] = get_data.reload
+    watcher = FileWatcher(callbacks, app.config.get('WATCH_INTERVAL', 1.0))
+    watcher.start()
+    return watcher
 
 
 def get_users():
@@ -124,39 +527,19 @@ def get_users():
             'avatar_url': 'http://.....'
         }
     }
-    """
-    data = {}
-    xml = parse(app.config['USERS_XML'])
-    root = xml.getroot()
-    server_info = root.find('server')
-    users = root.find('users')
-    server_url = _get_server_url(server_info)
-    for i, user_elem in enumerate(users):
-        try:
-            user_id = int(user_elem.attrib['id'])
-            name = user_elem.find('name').text
-            avatar = user_elem.find('avatar').text
-            avatar_url = '{0}{1}'.format(server_url, avatar)
-        except (KeyError, AttributeError):
-            log.debug('Problem with line %d: ', i, exc_info=True)
-
-        data[user_id] = {
-            'name': unicode(name),
-            'avatar_url': unicode(avatar_url),
-        }
 
-    return data
+    Parsed users are kept until the file changes, see UsersDirectory.
+    """
+    return get_users_directory().users
 
 
 def group_by_weekday(items):
     """
-    Groups presence entries by weekday.
+    Groups presence entries of single user (UserPresence) by weekday.
     """
     result = [[], [], [], [], [], [], []]  # one list for every day in week
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for day, start, end in items.rows():
+        result[weekday_of(day)].append(end - start)
     return result
 
 
@@ -168,21 +551,47 @@ def start_end_group_by_weekday(items):
     End key contains a list of starts for given day.
     """
     result = {i: {'start': [], 'end': []} for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        curr = result[date.weekday()]
-        curr['start'].append(seconds_since_midnight(start))
-        curr['end'].append(seconds_since_midnight(end))
+    for day, start, end in items.rows():
+        curr = result[weekday_of(day)]
+        curr['start'].append(start)
+        curr['end'].append(end)
     return result
 
 
+def quantiles_arg(default='50,90'):
+    """
+    Returns percentiles from comma separated `q` query parameter.
+    Raises ValueError for values which aren't numbers from 0 to 100.
+    """
+    result = [
+        float(value) for value in request.args.get('q', default).split(',')
+    ]
+    if not all(0 <= value <= 100 for value in result):
+        raise ValueError('Percentiles must be from 0 to 100')
+    return result
+
+
+def date_range_args():
+    """
+    Returns (first, last) date ordinals from `from` and `to` query
+    parameters (YYYY-MM-DD, both inclusive), None for missing ones.
+    Raises ValueError for malformed dates.
+    """
+    result = []
+    for name in ('from', 'to'):
+        value = request.args.get(name)
+        result.append(
+            datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+            if value else None
+        )
+    return tuple(result)
+
+
 def str_to_time(str_time):
     """
     Convert string rep. of time to time.
     """
-    import time
-    return time.strftime('%H:%M:%S', time.gmtime(str_time))
+    return format_seconds(str_time)
 
 
 def mean_start_end_by_weekday(grouped):
@@ -191,21 +600,14 @@ def mean_start_end_by_weekday(grouped):
     """
     result = [
         [
-            str_to_time(mean(item['start'])),
-            str_to_time(mean(item['end'])),
+            format_seconds(mean(item['start'])),
+            format_seconds(mean(item['end'])),
         ]
         for item in grouped.values()
     ]
     return result
 
 
-def seconds_since_midnight(time):
-    """
-    Calculates amount of seconds since midnight.
-    """
-    return time.hour * 3600 + time.minute * 60 + time.second
-
-
 def interval(start, end):
     """
     Calculates inverval in seconds between two datetime.time objects.
@@ -218,3 +620,59 @@ def mean(items):
     Calculates arithmetic mean. Returns zero for empty lists.
     """
     return float(sum(items)) / len(items) if len(items) > 0 else 0
+
+
+def mean_time_weekday(stats):
+    """
+    Mean presence time by weekday from weekday stats of user.
+    """
+    return user_series(stats)['mean_time_weekday']
+
+
+def presence_weekday(stats):
+    """
+    Total presence time by weekday from weekday stats of user.
+    """
+    return user_series(stats)['presence_weekday']
+
+
+def presence_start_end(stats):
+    """
+    Mean presence start and end time by weekday from weekday stats of user.
+    """
+    return user_series(stats)['presence_start_end']
+
+
+def percentiles_weekday(distribution, quantiles):
+    """
+    Percentiles of start time, end time and presence time (in seconds) by
+    weekday from WeekdayDistribution of user. Missing days give nulls.
+    """
+    result = []
+    for weekday in range(7):
+        item = {}
+        for kind in WeekdayDistribution.KINDS:
+            values = item[kind] = {}
+            for q in quantiles:
+                value = distribution.percentile(kind, weekday, q)
+                if value is not None and kind != 'interval':
+                    value = format_seconds(value)
+                values['{0:g}'.format(q)] = value
+        result.append((calendar.day_abbr[weekday], item))
+    return result
+
+
+def arrival_histogram(distribution, bin_size):
+    """
+    Counts of presence starts by weekday in bins of bin_size seconds
+    covering whole day.
+    """
+    edges = range(0, 24 * 3600, bin_size) + [24 * 3600]
+    return {
+        'bins': [format_seconds(edge) for edge in edges[:-1]],
+        'weekdays': [
+            (calendar.day_abbr[weekday],
+             distribution.histogram('start', weekday, edges))
+            for weekday in range(7)
+        ],
+    }
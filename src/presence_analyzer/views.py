@@ -3,26 +3,87 @@
 Defines views.
 """
 
-import calendar
-from flask import abort
+import time
+from flask import Response, abort, g, request
 from flask_mako import render_template
 from mako.exceptions import TopLevelLookupException
 
+from presence_analyzer.aggregation import (
+    merge_weekday_stats,
+    weekday_series,
+)
+from presence_analyzer.avatars import UpstreamError
 from presence_analyzer.main import app
+from presence_analyzer.metrics import (
+    METRICS,
+    server_timing_header,
+    timer,
+)
+from presence_analyzer.serialization import (
+    Payload,
+    compress_response,
+    dumps,
+)
 from presence_analyzer.utils import (
     jsonify,
-    get_data,
-    mean,
-    group_by_weekday,
-    start_end_group_by_weekday,
-    mean_start_end_by_weekday,
-    get_users
+    cached_response,
+    encoded_once,
+    data_version,
+    dashboard_version,
+    date_range_args,
+    get_groups,
+    groups_version,
+    users_version,
+    get_backend,
+    get_avatars,
+    mean_time_weekday,
+    presence_weekday,
+    presence_start_end,
+    percentiles_weekday,
+    arrival_histogram,
+    quantiles_arg,
+    get_users_directory,
+    offload,
+    offload_iter,
+    stream_json_object
 )
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+@app.before_request
+def start_request_timer():
+    """
+    Remembers when request processing started.
+    """
+    g.request_started = time.time()
+
+
+@app.after_request
+def record_request_time(response):
+    """
+    Records request duration and adds Server-Timing header when enabled.
+    """
+    started = g.get('request_started')
+    if started is not None:
+        METRICS.observe('request', time.time() - started,
+                        endpoint=request.endpoint or 'unknown')
+    if app.config.get('SERVER_TIMING'):
+        header = server_timing_header()
+        if header:
+            response.headers['Server-Timing'] = header
+    return response
+
+
+@app.after_request
+def compress(response):
+    """
+    Compresses large responses, negotiated via Accept-Encoding.
+    """
+    return compress_response(response)
+
+
 @app.route('/', defaults={'template_name': 'presence_weekday'})
 @app.route('/<string:template_name>', methods=['GET'])
 def render_page(template_name):
@@ -36,63 +97,147 @@ def render_page(template_name):
 
 
 @app.route('/api/v1/users', methods=['GET'])
+@cached_response(users_version)
 @jsonify
 def users_view():
     """
     Users listing for dropdown.
+
+    Optional query parameters: `sort` (user_id or name, '-' prefix for
+    descending order), `page` and `per_page`.
+    """
+    try:
+        payload = get_users_directory().payload(
+            sort=request.args.get('sort', 'user_id'),
+            page=request.args.get('page', 1, type=int),
+            per_page=request.args.get('per_page', None, type=int),
+        )
+    except ValueError:
+        log.debug('Invalid users listing request', exc_info=True)
+        abort(400)
+    return Payload(payload)
+
+
+PRESENCE_WEEKDAY_HEADER = ('Weekday', 'Presence (s)')
+
+
+def presence_weekday_with_header(stats):
+    """
+    Total presence time by weekday preceded by chart header.
+    """
+    result = presence_weekday(stats)
+    result.insert(0, PRESENCE_WEEKDAY_HEADER)
+    return result
+
+
+def get_date_range(data):
+    """
+    Returns date range requested by `from` and `to` query parameters.
+
+    Aborts with 400 when dates are malformed or data has no per-day entries
+    to filter.
+    """
+    try:
+        first, last = date_range_args()
+    except ValueError:
+        log.debug('Invalid date range', exc_info=True)
+        abort(400)
+    if (first is not None or last is not None) and not data.has_entries:
+        log.debug('Date range requested but data has no per-day entries')
+        abort(400)
+    return first, last
+
+
+BULK_STATS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday_with_header,
+    'presence_start_end_per_weekday': presence_start_end,
+}
+
+
+def stream_bulk_stats(data, stat, date_range):
+    """
+    Returns iterator of JSON object with statistic of every user.
     """
-    data = get_users()
-    return [
-        {'user_id': k, 'name': v['name'], 'avatar_url': v['avatar_url']}
-        for k, v in data.items()
-    ]
+    stats = BULK_STATS[stat]
+    return stream_json_object(
+        (user_id, stats(data.weekday_stats(user_id, *date_range)))
+        for user_id in sorted(data)
+    )
+
+
+# keys of weekday_series results of BULK_STATS
+BULK_SERIES = {
+    'mean_time_weekday': 'mean_time_weekday',
+    'presence_weekday': 'presence_weekday',
+    'presence_start_end_per_weekday': 'presence_start_end',
+}
+
+
+@encoded_once(data_version)
+def all_users_payload(stat):
+    """
+    Statistic of every user over all dates, encoded once per data version.
+
+    Statistics of all users are computed at once by weekday_series.
+    """
+    data = get_backend()
+    with timer('aggregation'):
+        series = weekday_series(
+            dict((user_id, data.weekday_stats(user_id)) for user_id in data))
+    result = []
+    for user_id in sorted(series):
+        value = series[user_id][BULK_SERIES[stat]]
+        if stat == 'presence_weekday':
+            value.insert(0, PRESENCE_WEEKDAY_HEADER)
+        result.append((user_id, value))
+    return ''.join(stream_json_object(result))
 
 
 @app.route('/api/v1/mean_time_weekday/',
            defaults={'user_id': 0},
            methods=['GET'])
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@cached_response(data_version)
 @jsonify
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+
+    Optional `from` and `to` query parameters (YYYY-MM-DD) limit entries
+    to given date range.
     """
-    data = get_data()
+    data = get_backend()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    return result
+    date_range = get_date_range(data)
+    with timer('aggregation'):
+        return mean_time_weekday(data.weekday_stats(user_id, *date_range))
 
 
 @app.route('/api/v1/presence_weekday/',
            defaults={'user_id': 0},
            methods=['GET'])
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@cached_response(data_version)
 @jsonify
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
+
+    Accepts `from` and `to` query parameters like mean_time_weekday_view.
     """
-    data = get_data()
+    data = get_backend()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    date_range = get_date_range(data)
+    with timer('aggregation'):
+        return presence_weekday_with_header(
+            data.weekday_stats(user_id, *date_range))
 
 
 @app.route('/api/v1/presence_start_end_per_weekday/',
@@ -100,21 +245,250 @@ def presence_weekday_view(user_id):
            methods=['GET'])
 @app.route('/api/v1/presence_start_end_per_weekday/<int:user_id>',
            methods=['GET'])
+@cached_response(data_version)
 @jsonify
 def presence_start_end_per_weekday_view(user_id):
     """
     Returns list of mean presence start and end time of given user
     grouped by weekday.
+
+    Accepts `from` and `to` query parameters like mean_time_weekday_view.
     """
-    data = get_data()
+    data = get_backend()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = start_end_group_by_weekday(data[user_id])
-    mean_start_end = mean_start_end_by_weekday(weekdays)
-    result = [
-        (calendar.day_abbr[weekday], start_end[0], start_end[1])
-        for weekday, start_end in enumerate(mean_start_end)
-    ]
-    return result
+    date_range = get_date_range(data)
+    with timer('aggregation'):
+        return presence_start_end(data.weekday_stats(user_id, *date_range))
+
+
+@app.route('/api/v1/dashboard/', defaults={'user_id': 0}, methods=['GET'])
+@app.route('/api/v1/dashboard/<int:user_id>', methods=['GET'])
+@cached_response(dashboard_version)
+@jsonify
+def dashboard_view(user_id):
+    """
+    Returns name and avatar of given user together with results of all
+    three weekday views, computed from one weekday_stats call.
+
+    Name and avatar_url are null for users missing in users file. Accepts
+    `from` and `to` query parameters like mean_time_weekday_view.
+    """
+    data = get_backend()
+    if user_id not in data:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    date_range = get_date_range(data)
+    user = get_users_directory().users.get(user_id, {})
+    with timer('aggregation'):
+        series = weekday_series(
+            {user_id: data.weekday_stats(user_id, *date_range)})[user_id]
+    series['presence_weekday'].insert(0, PRESENCE_WEEKDAY_HEADER)
+    series.update({
+        'user_id': user_id,
+        'name': user.get('name'),
+        'avatar_url': user.get('avatar_url'),
+    })
+    return series
+
+
+@app.route('/api/v1/avatars/', defaults={'user_id': 0}, methods=['GET'])
+@app.route('/api/v1/avatars/<int:user_id>', methods=['GET'])
+def avatar_view(user_id):
+    """
+    Returns avatar of given user from local cache, fetching it from
+    upstream when missing or due for revalidation.
+
+    Response has strong ETag of the image and may be cached by browsers for
+    AVATAR_MAX_AGE seconds. Aborts with 502 when upstream fails and no
+    cached avatar exists. Avatar is fetched in executor, see offload.
+    """
+    def fetch():
+        """
+        Returns (metadata, image) of avatar, None for unknown user.
+        """
+        user = get_users_directory().users.get(user_id)
+        if user is None:
+            return None
+        return get_avatars().get(str(user_id), user['avatar_url'])
+
+    try:
+        # users file parsing, upstream and disk I/O block, keep them off
+        # the event loop
+        avatar = offload(fetch)
+    except UpstreamError:
+        log.warning('Avatar of user %s unavailable', user_id, exc_info=True)
+        abort(502)
+    if avatar is None:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+    meta, body = avatar
+    response = Response(body, mimetype=meta['content_type'])
+    response.set_etag(meta['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('AVATAR_MAX_AGE', 86400)
+    return response.make_conditional(request)
+
+
+def get_distribution(user_id):
+    """
+    Returns WeekdayDistribution of user limited to requested date range.
+
+    Aborts with 404 for unknown user and with 400 when data has no per-day
+    entries.
+    """
+    data = get_backend()
+    if user_id not in data:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+    if not data.has_entries:
+        log.debug('Distribution requested but data has no per-day entries')
+        abort(400)
+    date_range = get_date_range(data)
+    with timer('aggregation'):
+        return data.weekday_distribution(user_id, *date_range)
+
+
+@app.route('/api/v1/percentiles_weekday/<int:user_id>', methods=['GET'])
+@cached_response(data_version)
+@jsonify
+def percentiles_weekday_view(user_id):
+    """
+    Returns percentiles of start time, end time and presence time of given
+    user grouped by weekday.
+
+    Percentiles are given as comma separated `q` query parameter (default
+    50,90, i.e. median and p90). Accepts `from` and `to` query parameters
+    like mean_time_weekday_view.
+    """
+    try:
+        quantiles = quantiles_arg()
+    except ValueError:
+        log.debug('Invalid percentiles', exc_info=True)
+        abort(400)
+    distribution = get_distribution(user_id)
+    with timer('aggregation'):
+        return percentiles_weekday(distribution, quantiles)
+
+
+@app.route('/api/v1/arrival_histogram/<int:user_id>', methods=['GET'])
+@cached_response(data_version)
+@jsonify
+def arrival_histogram_view(user_id):
+    """
+    Returns histogram of presence start times of given user by weekday.
+
+    Optional `bin` query parameter is bin width in seconds (60 to 86400,
+    default 1800). Accepts `from` and `to` query parameters like
+    mean_time_weekday_view.
+    """
+    bin_size = request.args.get('bin', 1800, type=int)
+    if not 60 <= bin_size <= 24 * 3600:
+        log.debug('Invalid histogram bin: %s', bin_size)
+        abort(400)
+    distribution = get_distribution(user_id)
+    with timer('aggregation'):
+        return arrival_histogram(distribution, bin_size)
+
+
+@app.route('/api/v1/bulk/<string:stat>', methods=['GET'])
+def bulk_stats_view(stat):
+    """
+    Returns statistic of many users at once, keyed by user_id.
+
+    Users are given as comma separated `user_ids` query parameter; `all`
+    returns statistic of every user, streamed when limited to date range.
+    Unknown users map to null. `from` and `to` query parameters limit
+    entries to given date range. Statistics are computed in executor, see
+    offload and offload_iter.
+    """
+    if stat not in BULK_STATS:
+        abort(404)
+    stats = BULK_STATS[stat]
+    data = get_backend()
+    date_range = get_date_range(data)
+    user_ids = request.args.get('user_ids', '')
+
+    if user_ids == 'all':
+        if date_range == (None, None):
+            return Response(offload(all_users_payload, stat),
+                            mimetype='application/json')
+        return Response(
+            offload_iter(stream_bulk_stats(data, stat, date_range)),
+            mimetype='application/json'
+        )
+
+    try:
+        user_ids = [int(user_id) for user_id in user_ids.split(',')]
+    except ValueError:
+        log.debug('Invalid user_ids: %r', user_ids)
+        abort(400)
+    return Response(
+        offload(lambda: dumps(dict(
+            (
+                user_id,
+                stats(data.weekday_stats(user_id, *date_range))
+                if user_id in data else None
+            )
+            for user_id in user_ids
+        ))),
+        mimetype='application/json'
+    )
+
+
+@app.route('/api/v1/groups', methods=['GET'])
+@cached_response(groups_version)
+@jsonify
+def groups_view():
+    """
+    Returns user groups, names mapped to lists of member ids.
+    """
+    return get_groups()
+
+
+# implicit group of every user with presence data
+ALL_USERS_GROUP = 'all'
+
+
+@app.route('/api/v1/rollup/<string:stat>/<string:group>', methods=['GET'])
+@cached_response(groups_version)
+@jsonify
+def rollup_view(stat, group):
+    """
+    Returns statistic (one of BULK_STATS) of whole group of users.
+
+    Weekday stats of members are summed, so means are taken over entries of
+    all members. Group `all` contains every user with presence data unless
+    defined otherwise; members without data are skipped. `from` and `to`
+    query parameters limit entries to given date range.
+    """
+    if stat not in BULK_STATS:
+        abort(404)
+    data = get_backend()
+    groups = get_groups()
+    if group in groups:
+        members = groups[group]
+    elif group == ALL_USERS_GROUP:
+        members = list(data)
+    else:
+        log.debug('Group %s not found!', group)
+        abort(404)
+
+    date_range = get_date_range(data)
+    with timer('aggregation'):
+        return BULK_STATS[stat](merge_weekday_stats(
+            data.weekday_stats(user_id, *date_range)
+            for user_id in members if user_id in data
+        ))
+
+
+@app.route('/api/v1/_metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns collected metrics in Prometheus text format.
+    """
+    return Response(METRICS.render(),
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Watching data files for changes.
+
+Uses inotify (pyinotify, optional dependency) when available and polls
+file stats otherwise.
+"""
+from __future__ import unicode_literals
+
+import os
+from threading import Event, Thread
+
+try:
+    import pyinotify
+except ImportError:  # pragma: no cover
+    pyinotify = None
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def file_identity(path):
+    """
+    Returns stat fields which change with content of the file, None for
+    missing file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class FileWatcher(Thread):
+    """
+    Background thread calling callback of watched file when it changes.
+
+    `callbacks` maps paths to functions called without arguments. Bursts of
+    changes (e.g. appends of many rows) result in one call after the file
+    settles for `interval` seconds. Files replaced by rename are noticed
+    too.
+    """
+    def __init__(self, callbacks, interval=1.0, use_inotify=True):
+        super(FileWatcher, self).__init__(name='file-watcher')
+        self.daemon = True
+        self.callbacks = dict(
+            (os.path.abspath(path), callback)
+            for path, callback in callbacks.iteritems()
+        )
+        self.interval = interval
+        self.use_inotify = use_inotify and pyinotify is not None
+        self._identities = dict(
+            (path, file_identity(path)) for path in self.callbacks
+        )
+        self._stopped = Event()
+
+    def stop(self):
+        """
+        Asks the thread to stop.
+        """
+        self._stopped.set()
+
+    def check(self, paths=None):
+        """
+        Calls callbacks of files (all by default) whose identity changed.
+        """
+        for path in paths or self.callbacks:
+            identity = file_identity(path)
+            if identity == self._identities[path]:
+                continue
+            self._identities[path] = identity
+            if identity is None:
+                log.warning('Watched file %s was removed', path)
+                continue
+            log.info('%s changed, reloading', path)
+            try:
+                self.callbacks[path]()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Reload after change of %s failed', path)
+
+    def run(self):
+        if self.use_inotify:
+            self._run_inotify()
+        else:
+            self._run_polling()
+
+    def _run_polling(self):
+        """
+        Checks stats of files every interval.
+        """
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def _run_inotify(self):
+        """
+        Waits for inotify events of directories containing watched files.
+        """
+        changed = set()
+
+        def remember(event):
+            """
+            Collects watched files touched by event.
+            """
+            if event.pathname in self.callbacks:
+                changed.add(event.pathname)
+
+        manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | \
+            pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+        for directory in set(map(os.path.dirname, self.callbacks)):
+            manager.add_watch(directory, mask)
+        notifier = pyinotify.Notifier(
+            manager, remember, timeout=int(self.interval * 1000))
+        try:
+            while not self._stopped.is_set():
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+                elif changed:
+                    self.check(list(changed))
+                    changed.clear()
+        finally:
+            notifier.stop()